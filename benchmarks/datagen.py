@@ -0,0 +1,205 @@
+"""
+Synthetic PartyFlow databases for benchmarking.
+
+    python benchmarks/datagen.py --tickets 1m --out /tmp/partyflow-1m.db
+
+The data is shaped like a real ticketing history rather than uniform noise:
+* event popularity is Zipf-skewed (a few sell-outs, a long tail of small events)
+* buyers are Zipf-skewed too (heavy repeat buyers with hundreds of tickets)
+* events span three years before ANCHOR_DATE and six months after it; most
+  past events are archived, upcoming ones are active
+* tickets come in orders of 1-4 seats with a purchase time before the event
+* sold_count / revenue counters match the tickets table, capacity >= sales
+
+A JSON sidecar (<db>.json) records the sizes and handy sample keys (heaviest
+buyer, most popular event, ...) so benchmarks don't have to search for them.
+The same --tickets / --seed always produce the same data.
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import itertools
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import db_manager
+
+GENERATOR_VERSION = 1
+TICKETS_PER_EVENT = 250   # Average; the Zipf skew decides the actual split
+TICKETS_PER_BUYER = 4
+EVENT_SKEW = 0.8
+BUYER_SKEW = 0.7
+INSERT_CHUNK = 50000
+# Dates are generated around a fixed day, so a dataset doesn't depend on when it was made
+ANCHOR_DATE = date(2026, 1, 1)
+
+VENUES = ["Tel Aviv", "Jerusalem", "Haifa", "Eilat", "Beersheba", "Herzliya", "Netanya", "Ashdod"]
+GENRES = ["Techno", "House", "Trance", "Hip Hop", "Reggae", "Jazz", "Rock", "Pop", "Latin", "Indie"]
+FORMATS = ["Night", "Festival", "Rooftop Party", "Beach Party", "Warehouse Rave", "Live Show", "Open Air"]
+
+
+def parse_size(text):
+    """'10k' -> 10000, '2.5M' -> 2500000."""
+    text = str(text).strip().lower()
+    multiplier = {"k": 1000, "m": 1000000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * multiplier)
+
+def format_size(count):
+    for suffix, size in (("m", 1000000), ("k", 1000)):
+        if count >= size and count % size == 0:
+            return f"{count // size}{suffix}"
+    return str(count)
+
+def zipf_cum_weights(count, skew, rng):
+    """Cumulative Zipf weights over `count` items, with the ranks shuffled across IDs."""
+    ranks = list(range(1, count + 1))
+    rng.shuffle(ranks)
+    return list(itertools.accumulate(1 / rank ** skew for rank in ranks))
+
+
+def generate(db_path, tickets, seed=1):
+    """Creates a fresh database at `db_path` with `tickets` tickets. Returns the dataset summary."""
+    rng = random.Random(seed)
+    started = time.monotonic()
+    for suffix in ("", "-wal", "-shm", ".json"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+    # Schema (and triggers) exactly as the app creates them
+    db_manager.DB_NAME = db_path
+    db_manager.create_tables()
+    db_manager.get_pool().close_all()
+
+    event_count = max(20, tickets // TICKETS_PER_EVENT)
+    buyer_count = max(10, tickets // TICKETS_PER_BUYER)
+
+    events = []
+    for i in range(event_count):
+        day = ANCHOR_DATE + timedelta(days=rng.randint(-3 * 365, 180))
+        events.append({
+            "name": f"{rng.choice(GENRES)} {rng.choice(FORMATS)} #{i + 1}",
+            "date": day,
+            "location": rng.choice(VENUES),
+            "price": float(rng.choice([40, 60, 80, 100, 120, 150, 200, 250])),
+            # Past events mostly end up archived
+            "is_active": 1 if day >= ANCHOR_DATE or rng.random() < 0.2 else 0,
+            "sold": 0,
+        })
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous = OFF")
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT INTO events (name, date, location, price, total_tickets, is_active) VALUES (?, ?, ?, ?, 0, ?)",
+        [(e["name"], e["date"].isoformat(), e["location"], e["price"], e["is_active"]) for e in events],
+    )
+
+    # Bulk load without the ticket indexes, then build them once (much faster than row by row)
+    index_sql = cursor.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'tickets' AND sql IS NOT NULL"
+    ).fetchall()
+    for name, _ in index_sql:
+        cursor.execute(f"DROP INDEX {name}")
+
+    event_weights = zipf_cum_weights(event_count, EVENT_SKEW, rng)
+    buyer_weights = zipf_cum_weights(buyer_count, BUYER_SKEW, rng)
+    buyer_tickets = [0] * buyer_count
+    order_number = 0
+    remaining = tickets
+    while remaining > 0:
+        # One order per (event, buyer) pair; 1-4 seats each
+        orders = max(1, min(INSERT_CHUNK, remaining) * 2 // 5)
+        event_picks = rng.choices(range(event_count), cum_weights=event_weights, k=orders)
+        buyer_picks = rng.choices(range(buyer_count), cum_weights=buyer_weights, k=orders)
+        rows = []
+        for event_index, buyer_index in zip(event_picks, buyer_picks):
+            quantity = min(rng.randint(1, 4), remaining - len(rows))
+            if quantity <= 0:
+                break
+            event = events[event_index]
+            order_number += 1
+            bought = datetime.combine(event["date"], datetime.min.time()) - timedelta(
+                seconds=rng.randint(3600, 60 * 24 * 3600)
+            )
+            user_id = 1000000 + buyer_index
+            row = (event_index + 1, user_id, f"Buyer {buyer_index + 1}", f"05{buyer_index:08d}",
+                   bought.strftime("%Y-%m-%d %H:%M:%S"), f"cs_synth_{order_number:09d}")
+            rows.extend([row] * quantity)
+            event["sold"] += quantity
+            buyer_tickets[buyer_index] += quantity
+        cursor.executemany(
+            "INSERT INTO tickets (event_id, user_id, user_name, phone_number, purchase_time, order_id) "
+            "VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+        remaining -= len(rows)
+
+    for _, sql in index_sql:
+        cursor.execute(sql)
+
+    # Counters + capacities consistent with the tickets (a few events sold out)
+    cursor.executemany(
+        "UPDATE events SET sold_count = ?, revenue = ? * price, total_tickets = ? WHERE id = ?",
+        [(e["sold"], e["sold"], max(50, e["sold"] if rng.random() < 0.1 else int(e["sold"] * rng.uniform(1.05, 1.6))),
+          i + 1) for i, e in enumerate(events)],
+    )
+    conn.commit()
+    cursor.execute("ANALYZE")
+    conn.close()
+
+    popular = max(range(event_count), key=lambda i: events[i]["sold"])
+    buyers = sorted((count, i) for i, count in enumerate(buyer_tickets) if count)
+    heaviest = buyers[-1][1]
+    summary = {
+        "generator_version": GENERATOR_VERSION,
+        "seed": seed,
+        "tickets": tickets,
+        "events": event_count,
+        "active_events": sum(e["is_active"] for e in events),
+        "buyers": len(buyers),
+        "popular_event_id": popular + 1,
+        "popular_event_sold": events[popular]["sold"],
+        "heaviest_buyer_id": 1000000 + heaviest,
+        "heaviest_buyer_tickets": buyer_tickets[heaviest],
+        "typical_buyer_id": 1000000 + buyers[len(buyers) // 2][1],  # Median buyer
+        "busiest_date": max(events, key=lambda e: e["sold"])["date"].isoformat(),
+        "search_term": GENRES[0],
+        "generated_in_s": round(time.monotonic() - started, 1),
+    }
+    with open(db_path + ".json", "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def load_summary(db_path):
+    """The sidecar summary of a generated database, or None if it is missing / outdated."""
+    try:
+        with open(db_path + ".json") as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if summary.get("generator_version") != GENERATOR_VERSION or not os.path.exists(db_path):
+        return None
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic PartyFlow database")
+    parser.add_argument("--tickets", default="100k", help="number of tickets, e.g. 10k, 1m, 10m")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="database path (default: benchmarks/data/partyflow-<tickets>.db)")
+    args = parser.parse_args()
+
+    tickets = parse_size(args.tickets)
+    out = args.out or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                                   f"partyflow-{format_size(tickets)}.db")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    print(f"Generating {tickets:,} tickets -> {out}")
+    print(json.dumps(generate(out, tickets, args.seed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+db_manager micro-benchmarks across dataset sizes, compared against a stored baseline.
+
+    python benchmarks/db_bench.py                       # 10k, 100k, 1m tickets vs baseline.json
+    python benchmarks/db_bench.py --scales 10k,10m      # any sizes (generated on first use)
+    python benchmarks/db_bench.py --save-baseline       # accept the current numbers
+
+Datasets come from datagen.py and are cached in benchmarks/data/. Every
+function is timed with a warm connection pool / page cache (the steady state
+of a running server): one warm-up call, then as many calls as fit in --budget
+seconds; the median is reported.
+
+The report answers two questions:
+* Which function breaks first? For each function, the smallest scale at which
+  one call takes longer than --latency-budget-ms (a request-path budget).
+* What got slower? Medians more than --threshold times the baseline (and at
+  least --min-delta-ms slower) are regressions; the exit status is 1 if any.
+
+Baselines depend on the machine: record one per CI runner / laptop.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import platform
+import statistics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import datagen
+from core import db_manager, stats
+
+DATA_DIR = os.path.join(BENCH_DIR, "data")
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+DEFAULT_SCALES = "10k,100k,1m"
+
+# Loading millions of rows into Python lists is a batch job, not a request; cap those
+FULL_LOAD_MAX_TICKETS = 1000000
+
+
+def _first(iterator):
+    return next(iterator, None)
+
+def _uncached_count(active_status, search_query=""):
+    db_manager._count_cache.clear()  # Time the query, not the per-version cache
+    return db_manager.count_events(active_status, search_query)
+
+# name -> (function(dataset summary), max tickets or None)
+BENCHMARKS = {
+    "get_events": (lambda d: db_manager.get_events(), None),
+    "get_catalog_version": (lambda d: db_manager.get_catalog_version(), None),
+    "get_events_page": (lambda d: db_manager.get_events_page(per_page=5), None),
+    "get_events_page:deep": (lambda d: db_manager.get_events_page(after_id=d["events"] * 9 // 10, per_page=5), None),
+    "get_events_page:back": (lambda d: db_manager.get_events_page(before_id=d["events"] // 2, per_page=5), None),
+    "get_events_page:search": (lambda d: db_manager.get_events_page(search_query=d["search_term"], per_page=5), None),
+    "get_events_page:search_deep": (
+        lambda d: db_manager.get_events_page(after_id=d["events"] * 9 // 10, search_query=d["search_term"], per_page=5),
+        None,
+    ),
+    "count_events": (lambda d: _uncached_count(1), None),
+    "count_events:search": (lambda d: _uncached_count(1, d["search_term"]), None),
+    "get_events_with_sales:active": (lambda d: db_manager.get_events_with_sales(), None),
+    "get_events_with_sales:page": (lambda d: db_manager.get_events_with_sales(range(1, 6)), None),
+    "get_event_by_id": (lambda d: db_manager.get_event_by_id(d["popular_event_id"]), None),
+    "get_tickets_sold": (lambda d: db_manager.get_tickets_sold(d["popular_event_id"]), None),
+    "get_total_revenue": (lambda d: db_manager.get_total_revenue(), None),
+    "get_total_tickets_sold": (lambda d: db_manager.get_total_tickets_sold(), None),
+    "get_top_event": (lambda d: db_manager.get_top_event(), None),
+    "stats.refresh:full": (lambda d: stats.refresh(full=True), None),
+    "get_user_tickets:page": (lambda d: db_manager.get_user_tickets(d["heaviest_buyer_id"], limit=20), None),
+    "get_user_tickets:typical": (lambda d: db_manager.get_user_tickets(d["typical_buyer_id"]), None),
+    "get_user_tickets:heaviest": (lambda d: db_manager.get_user_tickets(d["heaviest_buyer_id"]), None),
+    "get_order_tickets": (lambda d: db_manager.get_order_tickets("cs_synth_000000001"), None),
+    "get_events_by_date": (lambda d: db_manager.get_events_by_date(d["busiest_date"]), None),
+    "get_users_with_tickets_for_event": (
+        lambda d: db_manager.get_users_with_tickets_for_event(d["popular_event_id"]), None
+    ),
+    "get_sales_since": (lambda d: db_manager.get_sales_since(d["tickets"] - 100), None),
+    "iter_tickets_for_export:first_batch": (lambda d: _first(db_manager.iter_tickets_for_export()), None),
+    "get_all_events_for_export": (lambda d: db_manager.get_all_events_for_export(), None),
+    "get_all_tickets_for_export": (lambda d: db_manager.get_all_tickets_for_export(), FULL_LOAD_MAX_TICKETS),
+    "verify_sales_counters": (lambda d: db_manager.verify_sales_counters(), FULL_LOAD_MAX_TICKETS),
+}
+
+
+def dataset(tickets, seed):
+    """Path + summary of the cached dataset for `tickets`, generating it if needed."""
+    path = os.path.join(DATA_DIR, f"partyflow-{datagen.format_size(tickets)}-s{seed}.db")
+    summary = datagen.load_summary(path)
+    if summary is None or summary["seed"] != seed:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        print(f"⏳ Generating {tickets:,} tickets (cached in {DATA_DIR})...", flush=True)
+        summary = datagen.generate(path, tickets, seed)
+    return path, summary
+
+def time_call(function, summary, budget):
+    """Median / min seconds of `function(summary)`: one warm-up call, then calls until `budget` runs out."""
+    function(summary)
+    samples = []
+    deadline = time.perf_counter() + budget
+    while not samples or time.perf_counter() < deadline:
+        started = time.perf_counter()
+        function(summary)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples), min(samples), len(samples)
+
+def run(scales, seed, budget, selected):
+    """Returns {scale label: {benchmark: {median_ms, min_ms, runs} or {skipped}}}."""
+    results = {}
+    for tickets in scales:
+        label = datagen.format_size(tickets)
+        path, summary = dataset(tickets, seed)
+        db_manager.DB_NAME = path
+        print(f"\n📊 {label} tickets ({summary['events']:,} events, {summary['buyers']:,} buyers)", flush=True)
+
+        results[label] = {}
+        for name, (function, max_tickets) in BENCHMARKS.items():
+            if selected and not any(name.startswith(s) for s in selected):
+                continue
+            if max_tickets and tickets > max_tickets:
+                results[label][name] = {"skipped": f"over {datagen.format_size(max_tickets)} tickets"}
+                continue
+            median, fastest, runs = time_call(function, summary, budget)
+            results[label][name] = {
+                "median_ms": round(median * 1000, 3),
+                "min_ms": round(fastest * 1000, 3),
+                "runs": runs,
+            }
+            print(f"  {name:<40} {median * 1000:>10.3f} ms  ({runs} runs)", flush=True)
+        db_manager.get_pool().close_all()
+    return results
+
+
+def breaking_points(results, latency_budget_ms):
+    """For each benchmark: the first scale where one call exceeds the latency budget (None = never)."""
+    points = {}
+    for label, benches in results.items():
+        for name, result in benches.items():
+            points.setdefault(name, None)
+            if points[name] is None and result.get("median_ms", 0) > latency_budget_ms:
+                points[name] = label
+    return points
+
+def compare(results, baseline, threshold, min_delta_ms):
+    """Rows of (scale, benchmark, baseline ms, current ms, ratio, status)."""
+    rows = []
+    for label, benches in results.items():
+        for name, result in benches.items():
+            if "median_ms" not in result:
+                continue
+            before = baseline.get(label, {}).get(name, {}).get("median_ms")
+            now = result["median_ms"]
+            if before is None:
+                rows.append((label, name, None, now, None, "new"))
+                continue
+            ratio = now / before if before else float("inf")
+            if ratio > threshold and now - before > min_delta_ms:
+                status = "regression"
+            elif ratio < 1 / threshold and before - now > min_delta_ms:
+                status = "faster"
+            else:
+                status = "ok"
+            rows.append((label, name, before, now, round(ratio, 2), status))
+    return rows
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": f"{platform.system()} {platform.machine()}",
+        "cpus": os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="db_manager micro-benchmarks")
+    parser.add_argument("--scales", default=DEFAULT_SCALES, help="ticket counts, e.g. 10k,100k,1m,10m")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--budget", type=float, default=1.0, help="seconds of timing per function and scale")
+    parser.add_argument("--only", default="", help="comma-separated benchmark name prefixes")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=1.5, help="slowdown ratio counted as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5, help="ignore differences below this (noise)")
+    parser.add_argument("--latency-budget-ms", type=float, default=50, help="per-call budget for 'breaks at'")
+    parser.add_argument("--json", help="write the full report to this file")
+    args = parser.parse_args()
+
+    scales = sorted(datagen.parse_size(s) for s in args.scales.split(",") if s.strip())
+    selected = [s.strip() for s in args.only.split(",") if s.strip()]
+    results = run(scales, args.seed, args.budget, selected)
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {"results": {}}
+
+    rows = compare(results, baseline["results"], args.threshold, args.min_delta_ms)
+    points = breaking_points(results, args.latency_budget_ms)
+
+    print(f"\n{'scale':<6} {'benchmark':<40} {'baseline':>10} {'now':>10} {'ratio':>6}  status")
+    for label, name, before, now, ratio, status in rows:
+        before_text = f"{before:.3f}" if before is not None else "-"
+        ratio_text = f"{ratio:.2f}" if ratio is not None else "-"
+        marker = {"regression": "❌", "faster": "🚀"}.get(status, "")
+        print(f"{label:<6} {name:<40} {before_text:>10} {now:>10.3f} {ratio_text:>6}  {status} {marker}")
+
+    broken = {name: label for name, label in points.items() if label}
+    print(f"\nOver {args.latency_budget_ms:g} ms per call (first scale):")
+    for name, label in sorted(broken.items(), key=lambda item: datagen.parse_size(item[1])):
+        print(f"  {name:<40} from {label}")
+    if not broken:
+        print("  none ✅")
+
+    report = {
+        "environment": environment(),
+        "results": results,
+        "comparison": [dict(zip(("scale", "benchmark", "baseline_ms", "median_ms", "ratio", "status"), row))
+                       for row in rows],
+        "breaks_at": points,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        # Keep scales / benchmarks that weren't part of this run
+        merged = baseline.get("results", {})
+        for label, benches in results.items():
+            merged.setdefault(label, {}).update(benches)
+        with open(args.baseline, "w") as f:
+            json.dump({"environment": environment(), "results": merged}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nBaseline saved to {args.baseline}")
+        return
+
+    regressions = [row for row in rows if row[5] == "regression"]
+    if regressions:
+        print(f"\n❌ {len(regressions)} regression(s) vs baseline")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""
+Flash-sale load test: a ticket drop replayed against the real FastAPI app.
+
+    python benchmarks/flash_sale.py --buyers 2000 --concurrency 200 --capacity 500
+
+What it does:
+1. Seeds a fresh SQLite DB (in a temp dir) with --events events of --capacity seats.
+2. Starts local stand-ins for the Stripe Checkout API and the Telegram Bot API
+   (--stubs subprocess), and `main.app` under uvicorn pointed at them and at the
+   seeded DB (--serve subprocess). Nothing leaves the machine.
+3. Replays --buyers checkout flows (/create_checkout_session -> /payment_success)
+   with --concurrency in flight, while --browsers clients keep loading /events
+   and /dashboard.
+4. Prints a JSON report: p50/p90/p99 latency, throughput and error rate per
+   route, tickets issued vs capacity, oversold seats, counter mismatches and
+   Telegram deliveries. Exits with status 1 if any seat was oversold.
+
+"Sold out" answers (400 at checkout, the sold-out page after payment) are
+expected during a drop and counted separately from errors.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+TELEGRAM_TOKEN = "1:flash-sale-bench"
+STARTUP_TIMEOUT = 30
+
+
+# --- Stripe / Telegram stand-ins (--stubs) ---
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Stripe:   POST /v1/checkout/sessions, GET /v1/checkout/sessions/<id> (always 'paid')
+    Telegram: /bot<token>/<method> (sendPhoto / sendMessage / sendMediaGroup / ...)
+    GET /__stats -> request counters
+    """
+    protocol_version = "HTTP/1.1"
+    sessions = {}
+    counters = {"checkout_sessions": 0, "session_retrieves": 0, "telegram_calls": 0, "telegram_photos": 0}
+    lock = threading.Lock()
+    stripe_latency = 0.0
+    telegram_latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/__stats":
+            with self.lock:
+                return self._reply(200, dict(self.counters))
+        if path.startswith("/v1/checkout/sessions/"):
+            time.sleep(self.stripe_latency)
+            session = self.sessions.get(path.rsplit("/", 1)[1])
+            if session is None:
+                return self._reply(404, {"error": {"type": "invalid_request_error", "message": "No such session"}})
+            with self.lock:
+                self.counters["session_retrieves"] += 1
+            return self._reply(200, {**session, "payment_status": "paid", "status": "complete"})
+        if path.startswith("/bot"):
+            return self._telegram(path)
+        self._reply(404, {})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._body()
+        if path == "/v1/checkout/sessions":
+            time.sleep(self.stripe_latency)
+            form = parse_qs(body.decode())
+            metadata = {key[9:-1]: values[0] for key, values in form.items() if key.startswith("metadata[")}
+            with self.lock:
+                self.counters["checkout_sessions"] += 1
+                session_id = f"cs_test_{self.counters['checkout_sessions']:08d}"
+            session = {
+                "id": session_id,
+                "object": "checkout.session",
+                "url": f"http://{self.headers['Host']}/pay/{session_id}",
+                "payment_status": "unpaid",
+                "metadata": metadata,
+            }
+            self.sessions[session_id] = session
+            return self._reply(200, session)
+        if path.startswith("/bot"):
+            return self._telegram(path)
+        self._reply(404, {})
+
+    def _telegram(self, path):
+        time.sleep(self.telegram_latency)
+        method = path.rsplit("/", 1)[1]
+        with self.lock:
+            self.counters["telegram_calls"] += 1
+            number = self.counters["telegram_calls"]
+            if method == "sendPhoto":
+                self.counters["telegram_photos"] += 1
+        result = {"message_id": number, "chat": {"id": 0}, "date": int(time.time())}
+        if method == "sendPhoto":
+            result["photo"] = [{"file_id": f"photo-{number}", "file_unique_id": f"u{number}", "width": 290, "height": 290}]
+        elif method == "sendMediaGroup":
+            result = [result]
+        elif method in ("setWebhook", "deleteWebhook"):
+            result = True
+        self._reply(200, {"ok": True, "result": result})
+
+def run_stubs(port, stripe_latency_ms, telegram_latency_ms):
+    StubHandler.stripe_latency = stripe_latency_ms / 1000
+    StubHandler.telegram_latency = telegram_latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+# --- The app under test (--serve) ---
+
+def run_server(port, db_path, stub_url):
+    # Env first: main / telegram_client read their settings at import time
+    os.environ.update({
+        "TELEGRAM_TOKEN": TELEGRAM_TOKEN,
+        "TELEGRAM_API_URL": stub_url,
+        "TELEGRAM_WEBHOOK_URL": "",
+        "STRIPE_SECRET_KEY": "sk_test_flash_sale_bench",
+        "ADMIN_PASSWORD": os.environ.get("ADMIN_PASSWORD") or "bench",
+    })
+    os.chdir(REPO_ROOT)  # Templates / static are resolved relative to the repo
+    import stripe
+    import uvicorn
+    from core import db_manager
+    db_manager.DB_NAME = db_path
+    import main
+    stripe.api_base = stub_url
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+# --- Load generator ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def seed_database(db_path, events, capacity, price):
+    from core import db_manager
+    db_manager.DB_NAME = db_path
+    db_manager.create_tables()
+    for i in range(events):
+        db_manager.add_event(f"Flash Sale #{i + 1}", "2030-01-01", "Tel Aviv", price, capacity)
+    return list(range(1, events + 1))
+
+def summarize(samples, duration):
+    """Latency percentiles (ms), throughput and error rate of one route."""
+    latencies = sorted(sample[0] for sample in samples)
+    count = len(latencies)
+
+    def percentile(p):
+        return round(latencies[min(count - 1, int(count * p))] * 1000, 2) if count else 0
+
+    outcomes = {}
+    for _, outcome in samples:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return {
+        "requests": count,
+        "throughput_rps": round(count / duration, 1) if duration else 0,
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(latencies[-1] * 1000, 2) if count else 0,
+        "error_rate": round(outcomes.get("error", 0) / count, 4) if count else 0,
+        "outcomes": outcomes,
+    }
+
+async def run_load(base_url, event_ids, args):
+    import aiohttp
+
+    samples = {}  # route -> [(seconds, outcome)]
+    buyers_done = asyncio.Event()
+    connector = aiohttp.TCPConnector(limit=args.concurrency + args.browsers)
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+
+    async with aiohttp.ClientSession(base_url, connector=connector, timeout=timeout,
+                                     cookies={"session_user": "admin"}) as session:
+
+        async def timed(route, method, url, classify, **kwargs):
+            started = time.perf_counter()
+            try:
+                async with session.request(method, url, allow_redirects=False, **kwargs) as response:
+                    body = await response.text()
+                    outcome = classify(response.status, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                body, outcome = "", "error"
+            samples.setdefault(route, []).append((time.perf_counter() - started, outcome))
+            return outcome, body
+
+        def classify_checkout(status, body):
+            if status == 200:
+                return "ok"
+            return "sold_out" if status == 400 and "Not enough tickets" in body else "error"
+
+        def classify_payment(status, body):
+            if status != 200 or "Error processing payment" in body:
+                return "error"
+            return "sold_out" if "just sold out" in body else "ok"
+
+        def classify_page(status, body):
+            return "ok" if status in (200, 304) else "error"
+
+        async def buyer(number, slots):
+            async with slots:
+                ticket = {
+                    "event_id": random.choice(event_ids),
+                    "user_id": 100000 + number,
+                    "user_name": f"Buyer {number}",
+                    "phone_number": f"050{number:07d}",
+                    "quantity": random.randint(1, args.max_quantity),
+                }
+                outcome, body = await timed("POST /create_checkout_session", "POST",
+                                            "/create_checkout_session", classify_checkout, json=ticket)
+                if outcome != "ok":
+                    return
+                session_id = json.loads(body)["checkout_url"].rsplit("/", 1)[1]
+                await timed("GET /payment_success", "GET", "/payment_success", classify_payment,
+                            params={"session_id": session_id})
+
+        async def browser():
+            while not buyers_done.is_set():
+                await timed("GET /events", "GET", "/events", classify_page)
+                await timed("GET /dashboard", "GET", "/dashboard", classify_page)
+
+        slots = asyncio.Semaphore(args.concurrency)
+        browsers = [asyncio.create_task(browser()) for _ in range(args.browsers)]
+        started = time.perf_counter()
+        await asyncio.gather(*(buyer(number, slots) for number in range(args.buyers)))
+        duration = time.perf_counter() - started
+        buyers_done.set()
+        await asyncio.gather(*browsers)
+
+    return samples, duration
+
+def audit_database(db_path):
+    """Tickets issued vs capacity per event, plus stored-counter mismatches."""
+    from core import db_manager
+    db_manager.DB_NAME = db_path
+    with db_manager.get_connection() as conn:
+        rows = conn.execute('''
+            SELECT e.id, e.total_tickets, COUNT(t.id) AS issued
+            FROM events e LEFT JOIN tickets t ON t.event_id = e.id
+            GROUP BY e.id
+        ''').fetchall()
+        paid_orders = conn.execute("SELECT COUNT(DISTINCT order_id) FROM tickets").fetchone()[0]
+    return {
+        "capacity": sum(row["total_tickets"] for row in rows),
+        "tickets_issued": sum(row["issued"] for row in rows),
+        "orders_fulfilled": paid_orders,
+        "oversold_seats": sum(max(row["issued"] - row["total_tickets"], 0) for row in rows),
+        "counter_mismatches": len(db_manager.verify_sales_counters()),
+    }
+
+def stub_stats(stub_url):
+    import requests
+    return requests.get(f"{stub_url}/__stats", timeout=5).json()
+
+def wait_until_up(url, process):
+    import requests
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited during startup (status {process.returncode})")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {STARTUP_TIMEOUT}s")
+
+def wait_for_deliveries(stub_url, expected, seconds):
+    """Ticket QR delivery runs in background tasks; give it up to `seconds` to catch up."""
+    deadline = time.monotonic() + seconds
+    while True:
+        photos = stub_stats(stub_url)["telegram_photos"]
+        if photos >= expected or time.monotonic() >= deadline:
+            return photos
+        time.sleep(0.5)
+
+def main():
+    parser = argparse.ArgumentParser(description="PartyFlow flash-sale load test")
+    parser.add_argument("--buyers", type=int, default=2000, help="checkout flows to replay")
+    parser.add_argument("--concurrency", type=int, default=200, help="checkout flows in flight at once")
+    parser.add_argument("--browsers", type=int, default=20, help="clients looping over /events and /dashboard")
+    parser.add_argument("--events", type=int, default=1, help="events on sale")
+    parser.add_argument("--capacity", type=int, default=1000, help="seats per event")
+    parser.add_argument("--price", type=float, default=120.0)
+    parser.add_argument("--max-quantity", type=int, default=4, help="tickets per order: 1..N")
+    parser.add_argument("--stripe-latency-ms", type=float, default=0, help="simulated Stripe API latency")
+    parser.add_argument("--telegram-latency-ms", type=float, default=0, help="simulated Telegram API latency")
+    parser.add_argument("--drain-seconds", type=float, default=10, help="max wait for background ticket delivery")
+    parser.add_argument("--request-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    # Internal: the subprocess roles
+    parser.add_argument("--stubs", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    parser.add_argument("--stub-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stubs:
+        return run_stubs(args.port, args.stripe_latency_ms, args.telegram_latency_ms)
+    if args.serve:
+        return run_server(args.port, args.db, args.stub_url)
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="partyflow-flash-sale-")
+    db_path = os.path.join(workdir, "flash_sale.db")
+    event_ids = seed_database(db_path, args.events, args.capacity, args.price)
+
+    stub_port, app_port = free_port(), free_port()
+    stub_url, base_url = f"http://127.0.0.1:{stub_port}", f"http://127.0.0.1:{app_port}"
+    script = os.path.abspath(__file__)
+    processes = []
+    try:
+        processes.append(subprocess.Popen([
+            sys.executable, script, "--stubs", "--port", str(stub_port),
+            "--stripe-latency-ms", str(args.stripe_latency_ms), "--telegram-latency-ms", str(args.telegram_latency_ms),
+        ]))
+        wait_until_up(f"{stub_url}/__stats", processes[-1])
+        processes.append(subprocess.Popen([
+            sys.executable, script, "--serve", "--port", str(app_port), "--db", db_path, "--stub-url", stub_url,
+        ]))
+        wait_until_up(f"{base_url}/events", processes[-1])
+
+        print(f"🚀 {args.buyers} buyers ({args.concurrency} concurrent) + {args.browsers} browsers "
+              f"-> {args.events} event(s) x {args.capacity} seats", file=sys.stderr)
+        samples, duration = asyncio.run(run_load(base_url, event_ids, args))
+
+        audit = audit_database(db_path)
+        delivered = wait_for_deliveries(stub_url, audit["tickets_issued"], args.drain_seconds)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("stubs", "serve", "port", "db", "stub_url", "output")},
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(sum(len(s) for s in samples.values()) / duration, 1),
+        "routes": {route: summarize(route_samples, duration) for route, route_samples in sorted(samples.items())},
+        "inventory": audit,
+        "telegram": {"tickets_delivered": delivered, "tickets_pending": max(audit["tickets_issued"] - delivered, 0)},
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    if audit["oversold_seats"]:
+        print(f"❌ Oversold {audit['oversold_seats']} seat(s)!", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,15 @@ import os
 import telebot 
 import requests
 import phonenumbers 
-import qrcode 
 import logging
-from io import BytesIO 
+import threading
+import time
 from telebot import types  
 from dotenv import load_dotenv
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+from core import qr_service, conversation_state, update_dispatcher
+
 # --- Configuration & Setup ---
 
 # 1. Configure Logging
@@ -21,6 +23,7 @@ logging.basicConfig(
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 API_URL = os.getenv("API_URL")
+BOT_API_SECRET = os.getenv("BOT_API_SECRET", "")  # Must match the API's
 
 # 3. Check if token exists
 if not TELEGRAM_TOKEN:
@@ -28,11 +31,108 @@ if not TELEGRAM_TOKEN:
     exit()
 
 # 4. Initialize the bot
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
+class DispatchingTeleBot(telebot.TeleBot):
+    """Hands each update to the concurrent dispatcher instead of handling the batch in order."""
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # Mark as received right away, so polling doesn't fetch it again while it waits
+            self.last_update_id = max(self.last_update_id, update.update_id)
+            dispatcher.submit(update)  # Blocks while the dispatcher is full (backpressure)
+
+def update_chat_id(update):
+    """Ordering key of an update: its chat (updates without one only need to be handled)."""
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        # Handlers and conversation state key on call.message.chat.id; from_user only when the message is gone
+        message = update.callback_query.message
+        return message.chat.id if message else update.callback_query.from_user.id
+    return f"update-{update.update_id}"
+
+# Handlers run on the dispatcher's workers (threaded=False: no second thread pool in TeleBot)
+bot = DispatchingTeleBot(TELEGRAM_TOKEN, threaded=False)
+dispatcher = update_dispatcher.UpdateDispatcher(
+    lambda update: telebot.TeleBot.process_new_updates(bot, [update]),
+    key=update_chat_id
+)
 logging.info("Bot is running...")
 
-# Temporary dictionary to store data (In production, use Redis or DB)
-user_data = {}
+# Purchase-flow state per chat (memory / sqlite / redis, see BOT_STATE_BACKEND)
+sessions = conversation_state.get_store()
+
+# Event catalog cache: served as-is for CATALOG_TTL seconds, then revalidated with the API's ETag
+CATALOG_TTL = int(os.getenv("CATALOG_TTL_SECONDS", "30"))
+
+
+# --- Backend access ---
+
+class ApiClient:
+    """
+    Talks to the PartyFlow API over HTTP (polling mode, bot in its own process).
+    In webhook mode main.py swaps `backend` for an in-process version with the same methods.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        # Shared HTTP session: keeps connections to the API alive between commands
+        self.http = requests.Session()
+        self.catalog_cache = {"events": None, "etag": None, "checked_at": 0.0}
+        self.catalog_lock = threading.Lock()
+
+    def _url(self, path):
+        if not self.base_url:
+            raise RuntimeError("API_URL is missing.")
+        return f"{self.base_url}{path}"
+
+    def get_catalog(self):
+        """
+        Returns (status_code, events). Within the TTL no request is made; after it,
+        a conditional GET returns 304 (keep the cached list) unless an event was
+        added, archived or restored.
+        """
+        cache = self.catalog_cache
+        with self.catalog_lock:
+            if cache["events"] is not None and time.monotonic() - cache["checked_at"] < CATALOG_TTL:
+                return 200, cache["events"]
+
+            headers = {"If-None-Match": cache["etag"]} if cache["events"] is not None else {}
+            response = self.http.get(self._url("/events"), headers=headers, timeout=10)
+
+            if response.status_code == 304:
+                cache["checked_at"] = time.monotonic()
+                return 200, cache["events"]
+            if response.status_code != 200:
+                return response.status_code, None
+
+            cache.update(
+                events=response.json().get('events', []),
+                etag=response.headers.get("ETag"),
+                checked_at=time.monotonic()
+            )
+            return 200, cache["events"]
+
+    def get_tickets(self, user_id, after_id=0, limit=-1):
+        """Returns (status_code, {"tickets": [...], "next_after_id": ...})."""
+        response = self.http.get(
+            self._url(f"/api/tickets/{user_id}"), params={"after_id": after_id, "limit": limit}
+        )
+        return response.status_code, response.json() if response.status_code == 200 else None
+
+    def save_ticket_media(self, media):
+        if not BOT_API_SECRET:
+            return  # The API refuses media updates without it; images are simply re-uploaded next time
+        self.http.post(
+            self._url("/api/tickets/media"), json={"media": media}, headers={"X-Bot-Secret": BOT_API_SECRET}
+        )
+
+    def create_checkout(self, payload):
+        """Returns (status_code, {"checkout_url": ...})."""
+        response = self.http.post(self._url("/create_checkout_session"), json=payload)
+        return response.status_code, response.json() if response.status_code == 200 else None
+
+
+backend = ApiClient(API_URL)
 
 
 # --- Standard commands ---
@@ -44,17 +144,10 @@ def send_welcome(message):
 @bot.message_handler(commands=['events'])
 def list_events(message):
     try:
-        if not API_URL:
-            bot.reply_to(message, "Error: API_URL is missing.")
-            return
-        
-        # Fetch events from the backend
-        response = requests.get(f"{API_URL}/events")
-
-        if response.status_code == 200:
-            data = response.json()
-            events = data.get('events', [])
+        # Fetch events from the backend (cached, revalidated when stale)
+        status_code, events = backend.get_catalog()
 
+        if status_code == 200:
             if not events:
                 bot.reply_to(message, "No upcoming parties found")
                 return
@@ -75,7 +168,7 @@ def list_events(message):
                 bot.send_message(message.chat.id, event_text, reply_markup=markup, parse_mode="markdown")
 
         else:
-            bot.reply_to(message, f"Server Error: {response.status_code}")
+            bot.reply_to(message, f"Server Error: {status_code}")
 
     except Exception as e:
         bot.reply_to(message, f"Connection failed: {e}")
@@ -83,53 +176,115 @@ def list_events(message):
 
 # --- Command: View My Tickets ---
 
+TICKETS_PER_PAGE = 20
+MEDIA_GROUP_SIZE = 10  # Telegram's sendMediaGroup limit
+
 @bot.message_handler(commands=['my_tickets'])
 def my_tickets(message):
-    chat_id = message.chat.id
-    
-    try:
-        if not API_URL:
-            bot.reply_to(message, "Configuration Error: API_URL missing.")
-            return
+    send_tickets_page(message.chat.id)
 
-        # Request tickets from server
-        response = requests.get(f"{API_URL}/api/tickets/{chat_id}")
+# "Next page" button under a page of tickets
+@bot.callback_query_handler(func=lambda call: call.data.startswith("tickets_"))
+def next_tickets_page(call):
+    bot.answer_callback_query(call.id)
+    send_tickets_page(call.message.chat.id, int(call.data.split('_')[1]))
+
+def send_tickets_page(chat_id, after_id=0):
+    """Sends one page of the user's tickets as media groups (up to 10 photos per API call)."""
+    try:
+        # Request one page of tickets from server (keyset: tickets after `after_id`)
+        status_code, data = backend.get_tickets(chat_id, after_id, TICKETS_PER_PAGE)
         
-        if response.status_code == 200:
-            data = response.json()
+        if status_code == 200:
             tickets = data.get('tickets', [])
             
             if not tickets:
-                bot.reply_to(message, "You don't have any tickets yet. Type /events to buy one! 🎟️")
+                bot.send_message(chat_id, "You don't have any tickets yet. Type /events to buy one! 🎟️")
                 return
             
-            bot.send_message(chat_id, f"🎫 Found {len(tickets)} ticket(s):")
+            if after_id == 0:
+                bot.send_message(chat_id, "🎫 Your tickets:")
             
-            for ticket in tickets:
-                caption = (
-                    f"🎟️ **Ticket #{ticket['id']}**\n"
-                    f"🎉 Event: {ticket['name']}\n" 
-                    f"📅 Date: {ticket['date']}\n"
-                    f"📍 Location: {ticket['location']}"
-                )
-                
-                # Generate QR Code string
-                qr_data = f"TICKET-ID:{ticket['id']} | OWNER:{chat_id}"
-                qr_img = qrcode.make(qr_data)
-                
-                # Save to memory buffer
-                bio = BytesIO()
-                qr_img.save(bio, 'PNG')
-                bio.seek(0)
-                
-                # Send photo
-                bot.send_photo(chat_id, bio, caption=caption, parse_mode="markdown")
+            # Only images Telegram doesn't have yet are rendered (in one parallel batch)
+            missing = [ticket for ticket in tickets if not ticket.get('file_id')]
+            images = dict(zip(
+                [ticket['id'] for ticket in missing],
+                qr_service.render_many([ticket_qr_payload(ticket['id'], chat_id) for ticket in missing])
+            ))
+            
+            uploaded = []
+            for start in range(0, len(tickets), MEDIA_GROUP_SIZE):
+                uploaded += send_ticket_group(chat_id, tickets[start:start + MEDIA_GROUP_SIZE], images)
+            
+            if uploaded:
+                # Remember the file_ids so the next /my_tickets skips the uploads
+                backend.save_ticket_media(uploaded)
+            
+            next_after_id = data.get('next_after_id')
+            if next_after_id:
+                markup = InlineKeyboardMarkup()
+                markup.add(InlineKeyboardButton("➡️ Next page", callback_data=f"tickets_{next_after_id}"))
+                bot.send_message(chat_id, "There are more tickets:", reply_markup=markup)
                 
         else:
-            bot.reply_to(message, "Error fetching tickets from server.")
+            bot.send_message(chat_id, "Error fetching tickets from server.")
             
     except Exception as e:
-        bot.reply_to(message, f"Error: {e}")
+        bot.send_message(chat_id, f"Error: {e}")
+
+def ticket_qr_payload(ticket_id, chat_id):
+    return f"TICKET-ID:{ticket_id} | OWNER:{chat_id}"
+
+def ticket_caption(ticket):
+    return (
+        f"🎟️ **Ticket #{ticket['id']}**\n"
+        f"🎉 Event: {ticket['name']}\n" 
+        f"📅 Date: {ticket['date']}\n"
+        f"📍 Location: {ticket['location']}"
+    )
+
+def send_ticket_group(chat_id, tickets, images):
+    """
+    Sends up to 10 tickets in one call, re-using Telegram file_ids where known.
+    If Telegram rejects a file_id, the group is uploaded again from PNG bytes.
+    Returns [{ticket_id, file_id}] for every image that was uploaded.
+    """
+    def build_media(use_file_ids):
+        media = []
+        for ticket in tickets:
+            if use_file_ids and ticket.get('file_id'):
+                photo = ticket['file_id']
+            else:
+                photo = images[ticket['id']]
+            media.append(types.InputMediaPhoto(photo, caption=ticket_caption(ticket), parse_mode="markdown"))
+        return media
+
+    def send(media):
+        # sendMediaGroup needs at least 2 items
+        if len(media) == 1:
+            return [bot.send_photo(chat_id, media[0].media, caption=media[0].caption, parse_mode="markdown")]
+        return bot.send_media_group(chat_id, media)
+
+    try:
+        messages = send(build_media(use_file_ids=True))
+        reused = {ticket['id'] for ticket in tickets if ticket.get('file_id')}
+    except telebot.apihelper.ApiTelegramException as e:
+        if e.error_code != 400 or not any(ticket.get('file_id') for ticket in tickets):
+            raise
+        logging.warning(f"file_id rejected for tickets of {chat_id}, re-uploading")
+        stale = [ticket for ticket in tickets if ticket['id'] not in images]
+        images.update(zip(
+            [ticket['id'] for ticket in stale],
+            qr_service.render_many([ticket_qr_payload(ticket['id'], chat_id) for ticket in stale])
+        ))
+        messages = send(build_media(use_file_ids=False))
+        reused = set()
+
+    return [
+        {"ticket_id": ticket['id'], "file_id": sent.photo[-1].file_id}
+        for ticket, sent in zip(tickets, messages)
+        if ticket['id'] not in reused
+    ]
 
 
 # --- Smart Registration Flow ---
@@ -141,7 +296,7 @@ def ask_quantity(call):
     event_id = int(call.data.split('_')[1])
 
     # Save event_id to user session
-    user_data[chat_id] = {'event_id': event_id}
+    sessions.set(chat_id, {'event_id': event_id, 'step': 'quantity'})
 
     # Create buttons for quantity selection (1 to 5)
     markup = InlineKeyboardMarkup()
@@ -160,28 +315,26 @@ def ask_name(call):
     quantity = int(call.data.split('_')[1])
     
     # Save quantity if session exists
-    if chat_id in user_data:
-        user_data[chat_id]['quantity'] = quantity
-        msg = bot.send_message(chat_id, f"Ordering {quantity} ticket(s). \nWhat is your **Full Name**?")
-        bot.register_next_step_handler(msg, ask_phone)
+    state = sessions.get(chat_id)
+    if state:
+        state.update(quantity=quantity, step='name')
+        sessions.set(chat_id, state)
+        bot.send_message(chat_id, f"Ordering {quantity} ticket(s). \nWhat is your **Full Name**?")
     else:
         bot.send_message(chat_id, "Session expired. Please start over from /events.")
 
 # Step 3: Save name and ask for phone
-def ask_phone(message):
+def ask_phone(message, state):
     chat_id = message.chat.id
     name = message.text
 
     # Update user session with name
-    if chat_id in user_data:
-        user_data[chat_id]['name'] = name
-        msg = bot.send_message(chat_id, f"Nice to meet you, {name}! 👋\nNow, please enter your **Phone Number**:")
-        bot.register_next_step_handler(msg, validate_phone)
-    else:
-        bot.send_message(chat_id, "Session expired. Please start over.")
+    state.update(name=name, step='phone')
+    sessions.set(chat_id, state)
+    bot.send_message(chat_id, f"Nice to meet you, {name}! 👋\nNow, please enter your **Phone Number**:")
 
 # Step 4: Validate the phone number
-def validate_phone(message):
+def validate_phone(message, state):
     chat_id = message.chat.id
     phone_input = message.text
     
@@ -189,30 +342,23 @@ def validate_phone(message):
         # 1. Parse number (Assuming Israel default region)
         parsed_number = phonenumbers.parse(phone_input, "IL")
         
-        # 2. Check if valid
+        # 2. Check if valid (the session stays on the 'phone' step until it is)
         if not phonenumbers.is_valid_number(parsed_number):
-            msg = bot.send_message(chat_id, "❌ Invalid number. Please try again (e.g., 0501234567):")
-            bot.register_next_step_handler(msg, validate_phone) 
+            bot.send_message(chat_id, "❌ Invalid number. Please try again (e.g., 0501234567):")
             return
 
         # 3. Format nicely (E.164 standard)
         formatted_phone = phonenumbers.format_number(parsed_number, phonenumbers.PhoneNumberFormat.E164)
         
         # Save valid phone and proceed to payment
-        finalize_order(message, formatted_phone)
+        finalize_order(message, formatted_phone, state)
 
     except phonenumbers.NumberParseException:
-        msg = bot.send_message(chat_id, "❌ That doesn't look like a phone number. Try again:")
-        bot.register_next_step_handler(msg, validate_phone)
+        bot.send_message(chat_id, "❌ That doesn't look like a phone number. Try again:")
 
 # Step 5: Finalize purchase with server
-def finalize_order(message, valid_phone):
+def finalize_order(message, valid_phone, current_user):
     chat_id = message.chat.id
-    
-    current_user = user_data.get(chat_id)
-    if not current_user:
-        bot.send_message(chat_id, "Session expired. Please use /start again.")
-        return
 
     # Prepare payload with quantity
     payload = {
@@ -227,10 +373,9 @@ def finalize_order(message, valid_phone):
     
     try:
         # Send order to backend
-        response = requests.post(f"{API_URL}/create_checkout_session", json=payload)
+        status_code, data = backend.create_checkout(payload)
         
-        if response.status_code == 200:
-            data = response.json()
+        if status_code == 200:
             payment_url = data.get('checkout_url')
             
             markup = InlineKeyboardMarkup()
@@ -238,7 +383,7 @@ def finalize_order(message, valid_phone):
             
             bot.send_message(chat_id, "Ticket reserved! Please complete payment:", reply_markup=markup)
             
-        elif response.status_code == 400:
+        elif status_code == 400:
             bot.send_message(chat_id, "⚠️ Sorry, not enough tickets left for this request!")
         else:
             bot.send_message(chat_id, "❌ Error generating payment link.")
@@ -247,8 +392,38 @@ def finalize_order(message, valid_phone):
         bot.send_message(chat_id, f"Connection Error: {e}")
     
     # Clear session data
-    user_data.pop(chat_id, None)
-
-
-# 6. Start the bot
-bot.infinity_polling()
\ No newline at end of file
+    sessions.delete(chat_id)
+
+# Text replies are routed by the step stored in the chat's session
+# (registered last, so commands like /events still work mid-flow)
+STEP_HANDLERS = {
+    'name': ask_phone,
+    'phone': validate_phone,
+}
+
+@bot.message_handler(content_types=['text'])
+def handle_step_reply(message):
+    state = sessions.get(message.chat.id)
+    handler = STEP_HANDLERS.get(state.get('step')) if state else None
+    if handler:
+        handler(message, state)
+
+
+# 6. Start the bot (long polling).
+# In webhook mode (TELEGRAM_WEBHOOK_URL) the API imports these handlers and feeds them
+# updates itself; running this file switches the bot back to polling.
+STATS_LOG_INTERVAL = 60
+
+def log_dispatcher_stats():
+    while True:
+        time.sleep(STATS_LOG_INTERVAL)
+        stats = dispatcher.stats()
+        logging.info(
+            f"Dispatcher: {stats['processed']} handled, queue depth {stats['queue_depth']}, "
+            f"wait p95 {stats['queue_wait']['p95']}s, handler p95 {stats['handler_latency']['p95']}s"
+        )
+
+if __name__ == "__main__":
+    threading.Thread(target=log_dispatcher_stats, daemon=True).start()
+    bot.remove_webhook()
+    bot.infinity_polling()
\ No newline at end of file
@@ -0,0 +1,92 @@
+"""
+Broadcast engine: delivers one message to many chats without tripping
+Telegram's flood limits.
+
+* Recipients are streamed from the DB in chunks into a bounded queue, and a
+  fixed number of workers pull from it (bounded concurrency + memory).
+* Every send goes through telegram_client's global + per-chat token buckets and
+  is retried with backoff, honoring 429 `retry_after`.
+* Results are written to broadcast_recipients in batches, so progress survives
+  a restart and can be read by any API worker.
+"""
+import os
+import time
+import asyncio
+import logging
+
+from core import db_async, telegram_client
+
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+RECIPIENT_CHUNK_SIZE = 500
+RESULT_BATCH_SIZE = 100
+RESULT_FLUSH_SECONDS = 1.0
+
+
+async def run_broadcast(broadcast_id, text, parse_mode="Markdown"):
+    """Sends `text` to every still-pending recipient of the broadcast."""
+    progress = await db_async.get_broadcast_progress(broadcast_id)
+    if progress["status"] == "done":
+        return progress  # Already delivered (e.g. the same reminder triggered twice)
+
+    await db_async.set_broadcast_status(broadcast_id, "running")
+
+    # Bounded queue: recipients are streamed from the DB in chunks, never loaded all at once
+    queue = asyncio.Queue(maxsize=RECIPIENT_CHUNK_SIZE * 2)
+    results = []
+    last_flush = time.monotonic()
+
+    async def produce():
+        last_chat_id = None
+        while True:
+            chunk = await db_async.get_broadcast_recipients(
+                broadcast_id, "pending", last_chat_id, RECIPIENT_CHUNK_SIZE
+            )
+            if not chunk:
+                break
+            for chat_id in chunk:
+                await queue.put(chat_id)
+            last_chat_id = chunk[-1]
+        for _ in range(BROADCAST_CONCURRENCY):
+            await queue.put(None)  # One stop signal per worker
+
+    async def flush():
+        nonlocal results, last_flush
+        if results:
+            batch, results = results, []
+            await db_async.save_broadcast_results(broadcast_id, batch)
+        last_flush = time.monotonic()
+
+    async def worker():
+        while True:
+            chat_id = await queue.get()
+            if chat_id is None:
+                return
+
+            payload = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode}
+            status_code, body, attempts = await telegram_client.call_with_retry(
+                "sendMessage", payload, chat_id=chat_id
+            )
+            if status_code == 200:
+                results.append((chat_id, "sent", attempts, None))
+            else:
+                error = body.get("description") or f"HTTP {status_code}"
+                results.append((chat_id, "failed", attempts, error))
+
+            if len(results) >= RESULT_BATCH_SIZE or time.monotonic() - last_flush >= RESULT_FLUSH_SECONDS:
+                await flush()
+
+    workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_CONCURRENCY)]
+    try:
+        await asyncio.gather(produce(), *workers)
+    finally:
+        # Persist what was sent even if we are being cancelled (shutdown)
+        await asyncio.shield(flush())
+    # Only a completed run is 'done'; an interrupted one keeps its pending recipients for a resume
+    await db_async.set_broadcast_status(broadcast_id, "done")
+
+    progress = await db_async.get_broadcast_progress(broadcast_id)
+    logging.info(
+        f"✅ Broadcast #{broadcast_id} complete! Sent to {progress['counts'].get('sent', 0)}/{progress['total']} "
+        f"users ({progress['throughput']} msg/s)."
+    )
+    return progress
@@ -0,0 +1,131 @@
+"""
+Conversation state for the bot's purchase flow (event -> quantity -> name -> phone).
+
+Every chat's state is a small JSON-able dict with a sliding TTL, so abandoned
+checkouts disappear by themselves. Three interchangeable backends:
+
+* MemoryStateStore  - one process; LRU-bounded to BOT_STATE_MAX_SESSIONS chats
+* SQLiteStateStore  - survives restarts; shared by bot workers on the same host
+* RedisStateStore   - shared by bot workers anywhere (any Redis-compatible server)
+
+Pick one with BOT_STATE_BACKEND=memory|sqlite|redis (see get_store()).
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from core import db_manager
+
+try:
+    import redis
+except ImportError:  # Only needed for BOT_STATE_BACKEND=redis
+    redis = None
+
+BOT_STATE_BACKEND = os.getenv("BOT_STATE_BACKEND", "memory")
+BOT_STATE_TTL = int(os.getenv("BOT_STATE_TTL_SECONDS", "900"))
+BOT_STATE_MAX_SESSIONS = int(os.getenv("BOT_STATE_MAX_SESSIONS", "10000"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Expired SQLite sessions are deleted at most this often
+PURGE_INTERVAL = 60
+
+
+class MemoryStateStore:
+    """In-process store: LRU + TTL, never holds more than `max_sessions` chats."""
+
+    def __init__(self, ttl=BOT_STATE_TTL, max_sessions=BOT_STATE_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # chat_id -> (expires_at, state)
+        self._lock = threading.Lock()
+
+    def get(self, chat_id):
+        with self._lock:
+            entry = self._sessions.get(chat_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._sessions[chat_id]
+                return None
+            return dict(entry[1])
+
+    def set(self, chat_id, state):
+        with self._lock:
+            self._sessions[chat_id] = (time.monotonic() + self.ttl, dict(state))
+            self._sessions.move_to_end(chat_id)
+            # Oldest sessions go first once we are over the limit
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._sessions.pop(chat_id, None)
+
+
+class SQLiteStateStore:
+    """Stores sessions in the bot_sessions table of the PartyFlow database."""
+
+    def __init__(self, ttl=BOT_STATE_TTL):
+        self.ttl = ttl
+        self._last_purge = 0.0
+        db_manager.create_tables()  # The bot may start before the API has migrated the DB
+
+    def get(self, chat_id):
+        with db_manager.get_connection() as conn:
+            row = conn.execute(
+                "SELECT state FROM bot_sessions WHERE chat_id = ? AND expires_at > ?", (chat_id, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, chat_id, state):
+        now = time.time()
+        with db_manager.get_connection() as conn:
+            conn.execute('''
+                INSERT INTO bot_sessions (chat_id, state, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at
+            ''', (chat_id, json.dumps(state), now + self.ttl))
+            if now - self._last_purge >= PURGE_INTERVAL:
+                self._last_purge = now
+                conn.execute("DELETE FROM bot_sessions WHERE expires_at <= ?", (now,))
+            conn.commit()
+
+    def delete(self, chat_id):
+        with db_manager.get_connection() as conn:
+            conn.execute("DELETE FROM bot_sessions WHERE chat_id = ?", (chat_id,))
+            conn.commit()
+
+
+class RedisStateStore:
+    """One key per chat with a native expiry (works with Redis, Valkey, KeyDB, ...)."""
+
+    def __init__(self, url=REDIS_URL, ttl=BOT_STATE_TTL, prefix="partyflow:session:"):
+        if redis is None:
+            raise RuntimeError("BOT_STATE_BACKEND=redis requires the 'redis' package (pip install redis)")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, chat_id):
+        raw = self.client.get(f"{self.prefix}{chat_id}")
+        return json.loads(raw) if raw else None
+
+    def set(self, chat_id, state):
+        self.client.set(f"{self.prefix}{chat_id}", json.dumps(state), ex=self.ttl)
+
+    def delete(self, chat_id):
+        self.client.delete(f"{self.prefix}{chat_id}")
+
+
+BACKENDS = {
+    "memory": MemoryStateStore,
+    "sqlite": SQLiteStateStore,
+    "redis": RedisStateStore,
+}
+
+def get_store(backend=BOT_STATE_BACKEND):
+    """Creates the configured state store."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown BOT_STATE_BACKEND '{backend}' (choose from: {', '.join(BACKENDS)})")
+    return BACKENDS[backend]()
@@ -0,0 +1,137 @@
+"""
+Async access to db_manager / reservations for the API's event loop.
+
+    events = await db_async.get_events_with_sales([event_id])
+    hold = await db_async.create_hold(event_id, user_id, quantity)
+
+The DB functions the async routes and background jobs use have awaitable twins
+here (same names and arguments; add one when a new async caller needs it). They
+run the blocking sqlite3 call on a dedicated executor, sized like the connection
+pool (DB_ASYNC_WORKERS, default DB_POOL_SIZE). Async routes therefore never
+block the event loop, and DB work doesn't compete with sync routes, Stripe /
+Telegram calls or file downloads for Starlette's shared threadpool (~40 threads).
+Calls beyond the worker count queue here instead of piling up on the pool's lock.
+
+The caller's context is copied into the worker thread, so the SQL profiler
+(and anything else kept in contextvars) sees the request the call belongs to.
+"""
+import os
+import asyncio
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from core import db_manager, reservations
+
+DB_ASYNC_WORKERS = int(os.getenv("DB_ASYNC_WORKERS", str(db_manager.DB_POOL_SIZE)))
+
+executor = ThreadPoolExecutor(max_workers=DB_ASYNC_WORKERS, thread_name_prefix="db")
+
+_stats = {"submitted": 0, "completed": 0, "running": 0}
+_stats_lock = threading.Lock()
+
+
+def _call(func, args, kwargs):
+    with _stats_lock:
+        _stats["running"] += 1
+    try:
+        return func(*args, **kwargs)
+    finally:
+        with _stats_lock:
+            _stats["running"] -= 1
+            _stats["completed"] += 1
+
+async def run(func, *args, **kwargs):
+    """Runs a blocking DB function on the DB executor and awaits its result."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    with _stats_lock:
+        _stats["submitted"] += 1
+    return await loop.run_in_executor(executor, functools.partial(context.run, _call, func, args, kwargs))
+
+
+# --- Async variants (db_manager / reservations are looked up per call, so the metrics timers apply) ---
+
+# Catalog & dashboard
+async def get_catalog():
+    return await run(db_manager.get_catalog)
+
+async def get_event_by_id(event_id):
+    return await run(db_manager.get_event_by_id, event_id)
+
+async def get_events_with_sales(event_ids=None):
+    return await run(db_manager.get_events_with_sales, event_ids)
+
+async def get_events_page(after_id=0, before_id=None, per_page=5, search_query="", active_status=1):
+    return await run(db_manager.get_events_page, after_id, before_id, per_page, search_query, active_status)
+
+async def count_events(active_status=1, search_query=""):
+    return await run(db_manager.count_events, active_status, search_query)
+
+async def get_events_by_date(target_date):
+    return await run(db_manager.get_events_by_date, target_date)
+
+# Tickets & checkout
+async def get_user_tickets(user_id, after_id=0, limit=-1):
+    return await run(db_manager.get_user_tickets, user_id, after_id, limit)
+
+async def get_order_tickets(order_id):
+    return await run(db_manager.get_order_tickets, order_id)
+
+async def add_tickets_bulk(event_id, user, quantity, order_id=None):
+    return await run(db_manager.add_tickets_bulk, event_id, user, quantity, order_id)
+
+async def get_ticket_file_ids(ticket_ids, kind):
+    return await run(db_manager.get_ticket_file_ids, ticket_ids, kind)
+
+async def save_ticket_file_ids(kind, media):
+    return await run(db_manager.save_ticket_file_ids, kind, media)
+
+async def create_hold(event_id, user_id, quantity, ttl=reservations.HOLD_TTL_SECONDS):
+    return await run(reservations.create_hold, event_id, user_id, quantity, ttl)
+
+async def release_hold(hold_id):
+    return await run(reservations.release_hold, hold_id)
+
+async def convert_hold(hold_id, user, order_id=None):
+    return await run(reservations.convert_hold, hold_id, user, order_id)
+
+async def release_expired_holds():
+    return await run(reservations.release_expired_holds)
+
+# Broadcasts & scheduled jobs
+async def create_broadcast(event_id, message, dedupe_key=None):
+    return await run(db_manager.create_broadcast, event_id, message, dedupe_key)
+
+async def get_broadcast_recipients(broadcast_id, status="pending", after_chat_id=None, limit=1000):
+    return await run(db_manager.get_broadcast_recipients, broadcast_id, status, after_chat_id, limit)
+
+async def save_broadcast_results(broadcast_id, results):
+    return await run(db_manager.save_broadcast_results, broadcast_id, results)
+
+async def set_broadcast_status(broadcast_id, status):
+    return await run(db_manager.set_broadcast_status, broadcast_id, status)
+
+async def get_broadcast_progress(broadcast_id):
+    return await run(db_manager.get_broadcast_progress, broadcast_id)
+
+async def get_unfinished_broadcasts(dedupe_prefix):
+    return await run(db_manager.get_unfinished_broadcasts, dedupe_prefix)
+
+async def acquire_job_lock(name, owner, ttl):
+    return await run(db_manager.acquire_job_lock, name, owner, ttl)
+
+async def release_job_lock(name, owner):
+    return await run(db_manager.release_job_lock, name, owner)
+
+
+def get_stats():
+    """Executor load: calls waiting for a worker, running and completed."""
+    with _stats_lock:
+        return {
+            "workers": DB_ASYNC_WORKERS,
+            "queued": _stats["submitted"] - _stats["completed"] - _stats["running"],
+            "running": _stats["running"],
+            "completed": _stats["completed"],
+        }
@@ -1,265 +1,655 @@
 import sqlite3
 import os
+import re
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from core import migrations, sql_profiler
 
 # Path to the database file
 DB_NAME = os.path.join("database", "party_bot.db")
 
+# Connection pool settings (can be tuned from .env)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+DB_STATEMENT_CACHE = 256
+
+# --- Connection Pool ---
+
+class ConnectionPool:
+    """
+    Thread-safe pool of reusable SQLite connections.
+    Every connection runs in WAL mode with tuned pragmas, and keeps its own
+    prepared-statement cache, so repeated queries skip the SQL compile step.
+    """
+
+    def __init__(self, db_name, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.db_name = db_name
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._stats = {"hits": 0, "misses": 0, "waits": 0, "wait_time": 0.0}
+
+    def _connect(self):
+        """Opens a new connection and applies the performance pragmas."""
+        folder = os.path.dirname(self.db_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=self.timeout,
+            check_same_thread=False,  # Connections move between worker threads
+            cached_statements=DB_STATEMENT_CACHE,
+            factory=sql_profiler.connection_factory()  # Timed cursors when SQL_PROFILE=1
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def acquire(self):
+        """Returns an idle connection, opens a new one, or waits for one to be released."""
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self._stats["hits"] += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+                self._stats["misses"] += 1
+
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Pool is full -> wait for another thread to release a connection
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Database connection pool exhausted")
+
+        with self._lock:
+            self._stats["waits"] += 1
+            self._stats["wait_time"] += time.perf_counter() - start
+        return conn
+
+    def release(self, conn):
+        """Returns a connection to the pool (rolling back anything left uncommitted)."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Broken connection -> drop it instead of recycling
+            with self._lock:
+                self._created -= 1
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    def close_all(self):
+        """Closes every idle connection."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        """Snapshot of pool usage counters."""
+        with self._lock:
+            return {
+                **self._stats,
+                "wait_time": round(self._stats["wait_time"], 4),
+                "open_connections": self._created,
+                "idle_connections": self._idle.qsize(),
+                "pool_size": self.size,
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Returns the shared pool (re-created if DB_NAME was changed)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_name != DB_NAME:
+            if _pool is not None:
+                _pool.close_all()
+            _pool = ConnectionPool(DB_NAME)
+        return _pool
+
+@contextmanager
+def get_connection():
+    """Borrows a pooled connection for the duration of a `with` block."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+def get_pool_stats():
+    """Reports pool hits (reused connections), misses (new connections) and waits."""
+    return get_pool().stats()
+
+# --- Hot Queries ---
+# Run on (almost) every request. `check_query_plans` fails if any of them
+# falls back to a full table scan, so new code can't silently lose an index.
+
+ACTIVE_EVENTS_QUERY = "SELECT * FROM events WHERE is_active = 1"
+
+CATALOG_VERSION_QUERY = "SELECT version, updated_at FROM catalog_meta WHERE id = 1"
+
+TOP_EVENT_QUERY = '''
+    SELECT name, sold_count
+    FROM events
+    WHERE sold_count > 0
+    ORDER BY sold_count DESC
+    LIMIT 1
+'''
+
+USER_TICKETS_QUERY = '''
+    SELECT t.id, e.name, e.date, e.location, m.file_id
+    FROM tickets t
+    JOIN events e ON t.event_id = e.id
+    LEFT JOIN ticket_media m ON m.ticket_id = t.id AND m.kind = 'view'
+    WHERE t.user_id = ? AND t.id > ?
+    ORDER BY t.id
+    LIMIT ?
+'''
+
+EVENTS_BY_DATE_QUERY = "SELECT * FROM events WHERE date = ? AND is_active = 1"
+
+EVENT_ATTENDEES_QUERY = "SELECT DISTINCT user_id FROM tickets WHERE event_id = ?"
+
+# Events that sold tickets after a given ticket ID (stats snapshot refresh; a range on the primary key).
+# `+event_id` keeps the planner from skip-scanning idx_tickets_event_id over every event instead
+SALES_SINCE_QUERY = '''
+    SELECT event_id, MAX(id) AS last_ticket_id
+    FROM tickets
+    WHERE id > ?
+    GROUP BY +event_id
+'''
+
+# Dashboard list: keyset pages (id > cursor going forward, id < cursor going back)
+EVENTS_PAGE_QUERY = "SELECT * FROM events WHERE is_active = ? AND id > ? ORDER BY id ASC LIMIT ?"
+EVENTS_PAGE_BACK_QUERY = "SELECT * FROM events WHERE is_active = ? AND id < ? ORDER BY id DESC LIMIT ?"
+EVENTS_PAGE_COUNT_QUERY = "SELECT COUNT(*) FROM events WHERE is_active = ?"
+
+# Dashboard search: FTS5 over name + location, same keyset paging on the rowid (= event id).
+# CROSS JOIN pins the join order: FTS matches first, then the event row by primary key.
+EVENTS_SEARCH_QUERY = '''
+    SELECT e.* FROM events_fts f CROSS JOIN events e ON e.id = f.rowid
+    WHERE events_fts MATCH ? AND e.is_active = ? AND f.rowid > ?
+    ORDER BY f.rowid ASC LIMIT ?
+'''
+EVENTS_SEARCH_BACK_QUERY = '''
+    SELECT e.* FROM events_fts f CROSS JOIN events e ON e.id = f.rowid
+    WHERE events_fts MATCH ? AND e.is_active = ? AND f.rowid < ?
+    ORDER BY f.rowid DESC LIMIT ?
+'''
+EVENTS_SEARCH_COUNT_QUERY = '''
+    SELECT COUNT(*) FROM events_fts f CROSS JOIN events e ON e.id = f.rowid
+    WHERE events_fts MATCH ? AND e.is_active = ?
+'''
+
+# name -> (sql, sample parameters)
+HOT_QUERIES = {
+    "get_events": (ACTIVE_EVENTS_QUERY, ()),
+    "get_catalog_version": (CATALOG_VERSION_QUERY, ()),
+    "get_top_event": (TOP_EVENT_QUERY, ()),
+    "get_user_tickets": (USER_TICKETS_QUERY, (0, 0, 10)),
+    "get_events_by_date": (EVENTS_BY_DATE_QUERY, ("2000-01-01",)),
+    "get_users_with_tickets_for_event": (EVENT_ATTENDEES_QUERY, (0,)),
+    "get_sales_since": (SALES_SINCE_QUERY, (0,)),
+    "get_events_page": (EVENTS_PAGE_QUERY, (1, 0, 6)),
+    "get_events_page:back": (EVENTS_PAGE_BACK_QUERY, (1, 100, 6)),
+    "get_events_page:count": (EVENTS_PAGE_COUNT_QUERY, (1,)),
+    "get_events_page:search": (EVENTS_SEARCH_QUERY, ('"a"*', 1, 0, 6)),
+    "get_events_page:search_back": (EVENTS_SEARCH_BACK_QUERY, ('"a"*', 1, 100, 6)),
+    "get_events_page:search_count": (EVENTS_SEARCH_COUNT_QUERY, ('"a"*', 1)),
+}
+
+# Keyset queries: the index must deliver rows in cursor order. A sort means reading
+# every row that matches the filter just to return one page.
+KEYSET_QUERIES = {
+    "get_user_tickets", "get_events_page", "get_events_page:back",
+    "get_events_page:search", "get_events_page:search_back",
+}
+
+def check_query_plans():
+    """
+    Runs EXPLAIN QUERY PLAN on every registered hot query.
+    Returns a list of (query_name, plan_detail) for each full table scan found,
+    and for each keyset query that sorts (temp B-tree) or walks the bare primary key.
+    """
+    problems = []
+    with get_connection() as conn:
+        for name, (sql, params) in HOT_QUERIES.items():
+            for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+                detail = row[3]
+                # "SCAN events" = full table scan; "SCAN ... USING (COVERING) INDEX" is fine,
+                # and so is "SCAN f VIRTUAL TABLE INDEX ..." (an FTS index lookup)
+                if detail.startswith("SCAN ") and "USING" not in detail and "VIRTUAL TABLE" not in detail:
+                    problems.append((name, detail))
+                elif name in KEYSET_QUERIES and (
+                    detail.startswith("USE TEMP B-TREE FOR ORDER BY")
+                    # Range on the bare primary key: the other filters are checked row by row
+                    or "PRIMARY KEY (rowid>" in detail or "PRIMARY KEY (rowid<" in detail
+                ):
+                    problems.append((name, detail))
+    return problems
+
 # --- Existing Functions ---
 
 def create_tables():
-    """Creates the necessary tables if they don't exist."""
-    os.makedirs("database", exist_ok=True)
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    # Create Events table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            name TEXT NOT NULL, 
-            date TEXT NOT NULL, 
-            location TEXT NOT NULL, 
-            price REAL NOT NULL, 
-            total_tickets INTEGER NOT NULL,
-            is_active INTEGER DEFAULT 1
-        )
-    ''')
-    
-    # Create Tickets table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tickets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            event_id INTEGER NOT NULL, 
-            user_id INTEGER NOT NULL, 
-            user_name TEXT, 
-            phone_number TEXT, 
-            purchase_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP, 
-            FOREIGN KEY(event_id) REFERENCES events(id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    """Creates / upgrades the schema by running any pending migrations."""
+    with get_connection() as conn:
+        applied = migrations.migrate(conn)
+    for name in applied:
+        print(f"Applied migration: {name}")
+    return applied
 
 def add_ticket(event_id, user_id, user_name, phone_number):
     """Adds a new ticket to the database."""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO tickets (event_id, user_id, user_name, phone_number) 
-            VALUES (?, ?, ?, ?)
-        ''', (event_id, user_id, user_name, phone_number))
-        
-        conn.commit()
-        last_row_id = cursor.lastrowid # Returns the ID of the created ticket
-        conn.close()
-        return last_row_id
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO tickets (event_id, user_id, user_name, phone_number)
+                VALUES (?, ?, ?, ?)
+            ''', (event_id, user_id, user_name, phone_number))
+            ticket_id = cursor.lastrowid # Returns the ID of the created ticket
+
+            # Keep the event's sales counters in sync (same transaction)
+            cursor.execute('''
+                UPDATE events
+                SET sold_count = sold_count + 1, revenue = revenue + price
+                WHERE id = ?
+            ''', (event_id,))
+
+            conn.commit()
+            return ticket_id
     except Exception as e:
         print(f"Database Error: {e}")
         return False
 
+def add_tickets_bulk(event_id, user, quantity, order_id=None):
+    """
+    Issues `quantity` tickets in ONE write transaction (capacity check + insert).
+    user -> dict with user_id, user_name, phone_number
+    order_id -> optional idempotency key (e.g. Stripe session ID); repeating
+                the call for the same order returns the already issued tickets.
+    Returns (ticket IDs, created): created is False when the order's tickets already
+    existed. Ticket IDs are None if the event is missing / sold out.
+    """
+    if quantity < 1:
+        raise ValueError(f"Ticket quantity must be at least 1, got {quantity}")
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        # Take the write lock up front so concurrent buyers queue here instead of overselling
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if order_id:
+                existing = cursor.execute(
+                    "SELECT id FROM tickets WHERE order_id = ? ORDER BY id", (order_id,)
+                ).fetchall()
+                if existing:
+                    conn.rollback()
+                    return [row[0] for row in existing], False
+
+            # Atomic check-and-increment against capacity (seats held by other buyers are taken)
+            cursor.execute('''
+                UPDATE events
+                SET sold_count = sold_count + ?, revenue = revenue + price * ?
+                WHERE id = ? AND sold_count + held_count + ? <= total_tickets
+            ''', (quantity, quantity, event_id, quantity))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return None, False
+
+            ticket_ids = insert_ticket_rows(cursor, event_id, user, quantity, order_id)
+            conn.commit()
+            return ticket_ids, True
+        except Exception:
+            conn.rollback()
+            raise
+
+def insert_ticket_rows(cursor, event_id, user, quantity, order_id=None):
+    """
+    Inserts `quantity` tickets with one multi-row INSERT and returns their IDs.
+    The caller owns the transaction and must already have updated the event counters.
+    """
+    if quantity < 1:
+        raise ValueError(f"Ticket quantity must be at least 1, got {quantity}")
+    row = (event_id, user['user_id'], user['user_name'], user['phone_number'], order_id)
+    placeholders = ", ".join(["(?, ?, ?, ?, ?)"] * quantity)
+    rows = cursor.execute(f'''
+        INSERT INTO tickets (event_id, user_id, user_name, phone_number, order_id)
+        VALUES {placeholders}
+        RETURNING id
+    ''', row * quantity).fetchall()
+    return sorted(r[0] for r in rows)
+
+def get_order_tickets(order_id):
+    """Returns the ticket IDs already issued for a checkout order."""
+    with get_connection() as conn:
+        rows = conn.execute("SELECT id FROM tickets WHERE order_id = ? ORDER BY id", (order_id,)).fetchall()
+    return [row[0] for row in rows]
+
 def get_events():
     """Fetches all ACTIVE events."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    # Filter by is_active = 1
-    cursor.execute("SELECT * FROM events WHERE is_active = 1")
-    rows = cursor.fetchall()
-    conn.close()
+    with get_connection() as conn:
+        # Filter by is_active = 1
+        rows = conn.execute(ACTIVE_EVENTS_QUERY).fetchall()
     return [dict(row) for row in rows]
 
+# Active events of the current catalog version: (db_name, version, updated_at, events)
+_catalog_cache = None
+_catalog_lock = threading.Lock()
+
+def get_catalog_version():
+    """Returns (version, updated_at) of the event catalog (bumped by triggers on any event change)."""
+    with get_connection() as conn:
+        row = conn.execute(CATALOG_VERSION_QUERY).fetchone()
+    return row[0], row[1]
+
+def get_catalog():
+    """
+    Returns (version, updated_at, active events).
+    The events are only re-read from the DB when the catalog version moved,
+    so every API worker picks up add/archive/restore on its next request.
+    Live counters (sold_count, held_count) may lag until then.
+    """
+    global _catalog_cache
+    version, updated_at = get_catalog_version()
+    cached = _catalog_cache
+    if cached and cached[0] == DB_NAME and cached[1] == version:
+        return version, updated_at, cached[3]
+
+    with _catalog_lock:
+        events = get_events()
+        _catalog_cache = (DB_NAME, version, updated_at, events)
+    return version, updated_at, events
+
 def add_event(name, date, location, price, total_tickets):
     """Adds a new event."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO events (name, date, location, price, total_tickets, is_active) 
-        VALUES (?, ?, ?, ?, ?, 1)
-    ''', (name, date, location, price, total_tickets))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        conn.execute('''
+            INSERT INTO events (name, date, location, price, total_tickets, is_active)
+            VALUES (?, ?, ?, ?, ?, 1)
+        ''', (name, date, location, price, total_tickets))
+        conn.commit()
 
 def get_event_by_id(event_id):
     """Fetches a single event by ID."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM events WHERE id = ?", (event_id,))
-    event = cursor.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        event = conn.execute("SELECT * FROM events WHERE id = ?", (event_id,)).fetchone()
     return dict(event) if event else None
 
 def get_tickets_sold(event_id):
-    """Counts how many tickets were sold for a specific event."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM tickets WHERE event_id = ?", (event_id,))
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    """Returns how many tickets were sold for a specific event (stored counter)."""
+    with get_connection() as conn:
+        row = conn.execute("SELECT sold_count FROM events WHERE id = ?", (event_id,)).fetchone()
+    return row[0] if row else 0
+
+def get_events_with_sales(event_ids=None):
+    """
+    Fetches events together with sold / remaining / percent in one query.
+    event_ids=None -> all ACTIVE events
+    event_ids=[...] -> exactly those events (any status), in the given order
+    """
+    base_query = "SELECT e.*, e.sold_count AS sold FROM events e WHERE {where}"
+
+    with get_connection() as conn:
+        if event_ids is None:
+            rows = conn.execute(base_query.format(where="e.is_active = 1")).fetchall()
+            events = [dict(row) for row in rows]
+        else:
+            event_ids = list(event_ids)
+            by_id = {}
+            # Chunk the IN (...) list to stay below SQLite's bound-parameter limit
+            for i in range(0, len(event_ids), 500):
+                chunk = event_ids[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(base_query.format(where=f"e.id IN ({placeholders})"), chunk).fetchall()
+                for row in rows:
+                    by_id[row["id"]] = dict(row)
+            events = [by_id[event_id] for event_id in event_ids if event_id in by_id]
+
+    for event in events:
+        total = event['total_tickets']
+        # Seats held by in-progress checkouts are not available either
+        event['remaining'] = total - event['sold'] - event['held_count']
+        event['percent'] = int((event['sold'] / total) * 100) if total > 0 else 0
+    return events
 
 def get_total_revenue():
     """Calculates total revenue from all ticket sales."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT SUM(events.price) 
-        FROM tickets 
-        JOIN events ON tickets.event_id = events.id
-    ''')
-    result = cursor.fetchone()[0]
-    conn.close()
+    with get_connection() as conn:
+        result = conn.execute("SELECT SUM(revenue) FROM events").fetchone()[0]
     return round(result, 2) if result else 0
 
 def get_total_tickets_sold():
     """Counts total tickets sold across all events."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM tickets")
-    result = cursor.fetchone()[0]
-    conn.close()
+    with get_connection() as conn:
+        result = conn.execute("SELECT SUM(sold_count) FROM events").fetchone()[0]
     return result if result else 0
 
 def get_top_event():
     """Finds the event with the highest sales."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT events.name, COUNT(tickets.id) as ticket_count 
-        FROM tickets 
-        JOIN events ON tickets.event_id = events.id 
-        GROUP BY events.id 
-        ORDER BY ticket_count DESC 
-        LIMIT 1
-    ''')
-    result = cursor.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        result = conn.execute(TOP_EVENT_QUERY).fetchone()
     return result[0] if result else "No Sales Yet"
 
-def get_user_tickets(user_id):
-    """Fetches all tickets for a specific user ID."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # Query to join ticket data with event details
-    cursor.execute("""
-        SELECT t.id, e.name, e.date, e.location 
-        FROM tickets t
-        JOIN events e ON t.event_id = e.id
-        WHERE t.user_id = ?
-    """, (user_id,))
-    
-    rows = cursor.fetchall()
-    conn.close()
+def get_event_sales(event_ids=None):
+    """
+    Stored sales counters (id, name, is_active, sold_count, revenue) for the stats snapshot.
+    event_ids=None -> every event (active and archived)
+    """
+    query = "SELECT id, name, is_active, sold_count, revenue FROM events"
+    with get_connection() as conn:
+        if event_ids is None:
+            rows = conn.execute(query).fetchall()
+        else:
+            event_ids = list(event_ids)
+            rows = []
+            for i in range(0, len(event_ids), 500):
+                chunk = event_ids[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows += conn.execute(f"{query} WHERE id IN ({placeholders})", chunk).fetchall()
+    return [dict(row) for row in rows]
+
+def get_last_ticket_id():
+    """ID of the newest ticket (0 if none were sold yet)."""
+    with get_connection() as conn:
+        row = conn.execute("SELECT MAX(id) FROM tickets").fetchone()
+    return row[0] or 0
+
+def get_sales_since(after_ticket_id):
+    """Returns {event_id: newest ticket ID} for events that sold tickets after `after_ticket_id`."""
+    with get_connection() as conn:
+        rows = conn.execute(SALES_SINCE_QUERY, (after_ticket_id,)).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+def get_user_tickets(user_id, after_id=0, limit=-1):
+    """
+    Fetches a user's tickets in ticket ID order.
+    Keyset pagination: pass the last ID of the previous page as `after_id` (limit -1 = no limit).
+    """
+    with get_connection() as conn:
+        # Query to join ticket data with event details
+        rows = conn.execute(USER_TICKETS_QUERY, (user_id, after_id, limit)).fetchall()
     return [dict(row) for row in rows]
 
 def get_events_by_date(target_date):
     # Returns all events happening on a specific date (format: YYYY-MM-DD).
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM events WHERE date = ? AND is_active = 1", (target_date,))
-    rows = cursor.fetchall()
-    conn.close()
+    with get_connection() as conn:
+        rows = conn.execute(EVENTS_BY_DATE_QUERY, (target_date,)).fetchall()
     return [dict(row) for row in rows]
 
 def get_users_with_tickets_for_event(event_id):
     # Returns a list of user_ids that have a ticket for a specific event.
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT user_id FROM tickets WHERE event_id = ?", (event_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    with get_connection() as conn:
+        rows = conn.execute(EVENT_ATTENDEES_QUERY, (event_id,)).fetchall()
     return [row[0] for row in rows]
 
 # --- Pagination, Archive & Export Functions ---
 
-def get_events_paginated(page=1, per_page=5, search_query="", active_status=1):
+# Cached list counts: (db_name, catalog version, active_status, match) -> count.
+# The catalog version moves on every insert / archive / restore / rename, so a cached count is never stale.
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+COUNT_CACHE_MAX = 256
+
+def fts_match_query(search_query):
+    """Turns free text into an FTS5 query: every word must match (as a prefix) in name or location."""
+    words = re.findall(r"\w+", search_query)
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+def count_events(active_status=1, search_query=""):
+    """Number of events in the dashboard list (cached per catalog version)."""
+    match = fts_match_query(search_query) if search_query else ""
+    key = (DB_NAME, get_catalog_version()[0], active_status, match)
+    with _count_cache_lock:
+        if key in _count_cache:
+            return _count_cache[key]
+
+    with get_connection() as conn:
+        if match:
+            count = conn.execute(EVENTS_SEARCH_COUNT_QUERY, (match, active_status)).fetchone()[0]
+        elif search_query:
+            count = 0  # No searchable words (e.g. only punctuation)
+        else:
+            count = conn.execute(EVENTS_PAGE_COUNT_QUERY, (active_status,)).fetchone()[0]
+
+    with _count_cache_lock:
+        if len(_count_cache) >= COUNT_CACHE_MAX:
+            _count_cache.clear()
+        _count_cache[key] = count
+    return count
+
+def get_events_page(after_id=0, before_id=None, per_page=5, search_query="", active_status=1):
     """
-    active_status=1 -> fetches active events
-    active_status=0 -> fetches archived events
+    One page of the dashboard event list, in ID order, using keyset pagination
+    (no OFFSET, so deep pages cost the same as the first one).
+    after_id  -> the page after that event ID (0 = first page)
+    before_id -> the page before that event ID (going back)
+    search_query -> full-text search over name and location
+    Returns (events, next_after_id, prev_before_id); the cursors are None when there is no such page.
     """
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    offset = (page - 1) * per_page
-    
-    if search_query:
-        query = "SELECT * FROM events WHERE is_active = ? AND name LIKE ? ORDER BY id ASC LIMIT ? OFFSET ?"
-        params = (active_status, f"%{search_query}%", per_page, offset)
-        
-        count_query = "SELECT COUNT(*) FROM events WHERE is_active = ? AND name LIKE ?"
-        count_params = (active_status, f"%{search_query}%")
-    else:
-        query = "SELECT * FROM events WHERE is_active = ? ORDER BY id ASC LIMIT ? OFFSET ?"
-        params = (active_status, per_page, offset)
-        
-        count_query = "SELECT COUNT(*) FROM events WHERE is_active = ?"
-        count_params = (active_status,)
+    match = fts_match_query(search_query) if search_query else ""
+    if search_query and not match:
+        return [], None, None
 
-    cursor.execute(query, params)
-    events = [dict(row) for row in cursor.fetchall()]
+    backwards = before_id is not None
+    if match:
+        query = EVENTS_SEARCH_BACK_QUERY if backwards else EVENTS_SEARCH_QUERY
+        params = (match, active_status, before_id if backwards else after_id, per_page + 1)
+    else:
+        query = EVENTS_PAGE_BACK_QUERY if backwards else EVENTS_PAGE_QUERY
+        params = (active_status, before_id if backwards else after_id, per_page + 1)
 
-    cursor.execute(count_query, count_params)
-    total_items = cursor.fetchone()[0]
-    total_pages = (total_items + per_page - 1) // per_page
+    with get_connection() as conn:
+        # One extra row tells whether there is another page in this direction
+        rows = [dict(row) for row in conn.execute(query, params).fetchall()]
 
-    conn.close()
-    return events, total_pages
+    more = len(rows) > per_page
+    events = rows[:per_page]
+    if backwards:
+        events.reverse()
+        next_after_id = events[-1]["id"] if events else None
+        prev_before_id = events[0]["id"] if more else None
+    else:
+        next_after_id = events[-1]["id"] if more else None
+        prev_before_id = events[0]["id"] if events and after_id else None
+    return events, next_after_id, prev_before_id
 
 def archive_event(event_id):
     """Marks an event as archived (inactive)."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE events SET is_active = 0 WHERE id = ?", (event_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        conn.execute("UPDATE events SET is_active = 0 WHERE id = ?", (event_id,))
+        conn.commit()
 
 def restore_event(event_id):
     """Restores an archived event (sets is_active = 1)."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE events SET is_active = 1 WHERE id = ?", (event_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        conn.execute("UPDATE events SET is_active = 1 WHERE id = ?", (event_id,))
+        conn.commit()
 
-def get_all_events_for_export():
-    """Fetches all events with sales data for CSV export."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # Complex query that also fetches sold ticket count and revenue per event
+# Rows per export batch: memory use stays the same no matter how big the export is
+EXPORT_BATCH_SIZE = 1000
+
+def iter_events_for_export(date_from=None, date_to=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields active events with sales data in batches (lists of dicts), newest date first.
+    Optional date_from / date_to ('YYYY-MM-DD', inclusive) filter on the event date.
+    Each batch is its own short keyset query, so no connection is held between batches.
+    """
+    # Sold ticket count and revenue come straight from the stored counters
     query = '''
-        SELECT 
+        SELECT
             e.id, e.name, e.date, e.location, e.price, e.total_tickets,
-            COUNT(t.id) as sold_count,
-            (COUNT(t.id) * e.price) as revenue
+            e.sold_count, e.revenue
         FROM events e
-        LEFT JOIN tickets t ON e.id = t.event_id
-        WHERE e.is_active = 1
-        GROUP BY e.id
-        ORDER BY e.date DESC
+        WHERE {where}
+        ORDER BY e.date DESC, e.id DESC
+        LIMIT ?
     '''
-    
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    conditions, params = ["e.is_active = 1"], []
+    if date_from:
+        conditions.append("e.date >= ?")
+        params.append(str(date_from))
+    if date_to:
+        conditions.append("e.date <= ?")
+        params.append(str(date_to))
 
-def get_all_tickets_for_export():
-    """Fetches all tickets with event details for the Guest List export."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
+    last = None
+    while True:
+        where, page_params = list(conditions), list(params)
+        if last:
+            where.append("(e.date, e.id) < (?, ?)")
+            page_params += [last["date"], last["id"]]
+
+        with get_connection() as conn:
+            rows = conn.execute(query.format(where=" AND ".join(where)), page_params + [batch_size]).fetchall()
+        if not rows:
+            return
+        batch = [dict(row) for row in rows]
+        yield batch
+        last = batch[-1]
+
+def iter_tickets_for_export(event_id=None, date_from=None, date_to=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields tickets with event details for the Guest List export in batches (lists of dicts),
+    newest first. Optional filters: event_id, and date_from / date_to on the purchase date.
+    """
     # Query linking ticket to event details
     query = '''
-        SELECT 
+        SELECT
             t.id as ticket_id,
             e.name as event_name,
             t.user_name,
@@ -268,10 +658,243 @@ def get_all_tickets_for_export():
             t.user_id as telegram_id
         FROM tickets t
         JOIN events e ON t.event_id = e.id
+        WHERE {where}
         ORDER BY t.id DESC
+        LIMIT ?
     '''
-    
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
\ No newline at end of file
+    conditions, params = [], []
+    if event_id is not None:
+        conditions.append("t.event_id = ?")
+        params.append(event_id)
+    if date_from:
+        conditions.append("t.purchase_time >= ?")
+        params.append(str(date_from))
+    if date_to:
+        conditions.append("t.purchase_time < date(?, '+1 day')")
+        params.append(str(date_to))
+
+    last_id = None
+    while True:
+        where, page_params = list(conditions), list(params)
+        if last_id is not None:
+            where.append("t.id < ?")
+            page_params.append(last_id)
+
+        with get_connection() as conn:
+            rows = conn.execute(
+                query.format(where=" AND ".join(where) or "1 = 1"), page_params + [batch_size]
+            ).fetchall()
+        if not rows:
+            return
+        batch = [dict(row) for row in rows]
+        yield batch
+        last_id = batch[-1]["ticket_id"]
+
+def get_all_events_for_export():
+    """Fetches all events with sales data for CSV export."""
+    return [event for batch in iter_events_for_export() for event in batch]
+
+def get_all_tickets_for_export():
+    """Fetches all tickets with event details for the Guest List export."""
+    return [ticket for batch in iter_tickets_for_export() for ticket in batch]
+
+# --- Sales Counter Maintenance ---
+
+def rebuild_sales_counters():
+    """Recomputes events.sold_count / revenue / held_count from tickets and live holds."""
+    with get_connection() as conn:
+        cursor = conn.execute('''
+            UPDATE events
+            SET sold_count = (SELECT COUNT(*) FROM tickets t WHERE t.event_id = events.id),
+                revenue = price * (SELECT COUNT(*) FROM tickets t WHERE t.event_id = events.id),
+                held_count = (SELECT COALESCE(SUM(h.quantity), 0) FROM ticket_holds h
+                              WHERE h.event_id = events.id AND h.status = 'held')
+        ''')
+        conn.commit()
+        return cursor.rowcount
+
+def verify_sales_counters():
+    """Returns the events whose stored counters don't match the tickets table."""
+    with get_connection() as conn:
+        rows = conn.execute('''
+            SELECT e.id, e.name, e.sold_count, COUNT(t.id) AS actual_count,
+                   e.revenue, COUNT(t.id) * e.price AS actual_revenue
+            FROM events e
+            LEFT JOIN tickets t ON t.event_id = e.id
+            GROUP BY e.id
+            HAVING e.sold_count != actual_count OR ABS(e.revenue - actual_revenue) > 0.005
+        ''').fetchall()
+    return [dict(row) for row in rows]
+
+# --- Broadcast Functions ---
+
+def create_broadcast(event_id, message, dedupe_key=None):
+    """
+    Stores a broadcast job for every ticket holder of the event (one 'pending'
+    row per recipient, copied inside SQLite - no Python-side list).
+    dedupe_key -> if a broadcast with this key already exists, its ID is returned
+                  instead of creating a second one (e.g. one reminder per event per day).
+    Returns the broadcast ID.
+    """
+    now = time.time()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if dedupe_key:
+                existing = cursor.execute(
+                    "SELECT id FROM broadcasts WHERE dedupe_key = ?", (dedupe_key,)
+                ).fetchone()
+                if existing:
+                    conn.rollback()
+                    return existing[0]
+
+            cursor.execute('''
+                INSERT INTO broadcasts (event_id, message, status, total, created_at, dedupe_key)
+                VALUES (?, ?, 'pending', 0, ?, ?)
+            ''', (event_id, message, now, dedupe_key))
+            broadcast_id = cursor.lastrowid
+            cursor.execute('''
+                INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, chat_id)
+                SELECT DISTINCT ?, user_id FROM tickets WHERE event_id = ?
+            ''', (broadcast_id, event_id))
+            cursor.execute(
+                "UPDATE broadcasts SET total = ? WHERE id = ?", (cursor.rowcount, broadcast_id)
+            )
+            conn.commit()
+            return broadcast_id
+        except Exception:
+            conn.rollback()
+            raise
+
+def get_broadcast_recipients(broadcast_id, status='pending', after_chat_id=None, limit=1000):
+    """
+    Returns up to `limit` chat IDs of a broadcast in the given delivery status,
+    ordered by chat ID. Pass the last ID of the previous chunk as after_chat_id to continue.
+    """
+    after = after_chat_id if after_chat_id is not None else -2 ** 63
+    with get_connection() as conn:
+        rows = conn.execute('''
+            SELECT chat_id FROM broadcast_recipients
+            WHERE broadcast_id = ? AND status = ? AND chat_id > ?
+            ORDER BY chat_id
+            LIMIT ?
+        ''', (broadcast_id, status, after, limit)).fetchall()
+    return [row[0] for row in rows]
+
+def save_broadcast_results(broadcast_id, results):
+    """Batch-updates recipients. results -> list of (chat_id, status, attempts, error)."""
+    now = time.time()
+    with get_connection() as conn:
+        conn.executemany('''
+            UPDATE broadcast_recipients
+            SET status = ?, attempts = attempts + ?, error = ?, updated_at = ?
+            WHERE broadcast_id = ? AND chat_id = ?
+        ''', [(status, attempts, error, now, broadcast_id, chat_id)
+              for chat_id, status, attempts, error in results])
+        conn.commit()
+
+def set_broadcast_status(broadcast_id, status):
+    """Moves a broadcast to 'running' or 'done' (recording the start / finish time)."""
+    column = "started_at" if status == "running" else "finished_at"
+    with get_connection() as conn:
+        conn.execute(
+            f"UPDATE broadcasts SET status = ?, {column} = ? WHERE id = ?",
+            (status, time.time(), broadcast_id)
+        )
+        conn.commit()
+
+def get_broadcast_progress(broadcast_id):
+    """Broadcast details with per-status recipient counts and throughput (msgs/sec)."""
+    with get_connection() as conn:
+        broadcast = conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+        if not broadcast:
+            return None
+        counts = conn.execute('''
+            SELECT status, COUNT(*) FROM broadcast_recipients
+            WHERE broadcast_id = ? GROUP BY status
+        ''', (broadcast_id,)).fetchall()
+
+    progress = dict(broadcast)
+    progress["counts"] = {status: count for status, count in counts}
+    done = progress["counts"].get("sent", 0) + progress["counts"].get("failed", 0)
+    progress["percent"] = int(done / progress["total"] * 100) if progress["total"] else 100
+
+    elapsed = None
+    if progress["started_at"]:
+        elapsed = (progress["finished_at"] or time.time()) - progress["started_at"]
+    progress["throughput"] = round(done / elapsed, 2) if elapsed else 0
+    return progress
+
+def get_recent_broadcasts(limit=10):
+    """Latest broadcast jobs, newest first."""
+    with get_connection() as conn:
+        rows = conn.execute("SELECT id FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [get_broadcast_progress(row[0]) for row in rows]
+
+def get_unfinished_broadcasts(dedupe_prefix):
+    """Broadcasts (matching a dedupe_key prefix) that never reached 'done'."""
+    with get_connection() as conn:
+        rows = conn.execute(
+            "SELECT id, message, dedupe_key FROM broadcasts WHERE dedupe_key LIKE ? AND status != 'done'",
+            (f"{dedupe_prefix}%",)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+# --- Ticket Media (Telegram file_id cache) ---
+
+def get_ticket_file_ids(ticket_ids, kind):
+    """Returns {ticket_id: file_id} for tickets whose image was already uploaded to Telegram."""
+    file_ids = {}
+    ticket_ids = list(ticket_ids)
+    with get_connection() as conn:
+        for start in range(0, len(ticket_ids), 500):
+            chunk = ticket_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT ticket_id, file_id FROM ticket_media WHERE kind = ? AND ticket_id IN ({placeholders})",
+                [kind, *chunk]
+            ).fetchall()
+            file_ids.update((row[0], row[1]) for row in rows)
+    return file_ids
+
+def save_ticket_file_ids(kind, media):
+    """Stores (ticket_id, file_id) pairs, replacing a file_id Telegram stopped accepting."""
+    now = time.time()
+    with get_connection() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO ticket_media (ticket_id, kind, file_id, updated_at) VALUES (?, ?, ?, ?)",
+            [(ticket_id, kind, file_id, now) for ticket_id, file_id in media]
+        )
+        conn.commit()
+
+# --- Scheduled Job Locks ---
+
+def acquire_job_lock(name, owner, ttl):
+    """
+    Lease lock shared by all API workers: only one process runs a scheduled job.
+    Returns True if `owner` now holds the lock for `ttl` seconds.
+    """
+    now = time.time()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            row = cursor.execute("SELECT owner, expires_at FROM job_locks WHERE name = ?", (name,)).fetchone()
+            if row and row["owner"] != owner and row["expires_at"] > now:
+                conn.rollback()
+                return False
+            cursor.execute(
+                "INSERT OR REPLACE INTO job_locks (name, owner, expires_at) VALUES (?, ?, ?)",
+                (name, owner, now + ttl)
+            )
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+def release_job_lock(name, owner):
+    with get_connection() as conn:
+        conn.execute("DELETE FROM job_locks WHERE name = ? AND owner = ?", (name, owner))
+        conn.commit()
@@ -0,0 +1,176 @@
+"""
+Export writers for the dashboard downloads (events report, guest list).
+
+Every format consumes the same stream of DB batches (db_manager.iter_*_for_export)
+and yields the file chunk by chunk, so memory stays flat for any export size:
+
+* csv      - the classic spreadsheet export (header row + raw values)
+* ndjson   - one JSON object per line with typed values (ISO dates / timestamps)
+* parquet  - columnar, one row group per batch          (needs pyarrow)
+* arrow    - Arrow IPC stream, one record batch per batch (needs pyarrow)
+"""
+import csv
+import json
+from io import StringIO
+from datetime import date, datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for the columnar formats
+    pa = pq = None
+
+# format -> (media type, file extension, needs pyarrow)
+FORMATS = {
+    "csv": ("text/csv", "csv", False),
+    "ndjson": ("application/x-ndjson", "ndjson", False),
+    "parquet": ("application/vnd.apache.parquet", "parquet", True),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows", True),
+}
+
+# Columns: (row key, CSV header, type)
+EVENT_COLUMNS = [
+    ("id", "ID", "int"),
+    ("name", "Event Name", "str"),
+    ("date", "Date", "date"),
+    ("location", "Location", "str"),
+    ("price", "Price (NIS)", "float"),
+    ("total_tickets", "Capacity", "int"),
+    ("sold_count", "Tickets Sold", "int"),
+    ("revenue", "Revenue", "float"),
+]
+
+TICKET_COLUMNS = [
+    ("ticket_id", "Ticket ID", "int"),
+    ("event_name", "Event Name", "str"),
+    ("user_name", "Owner Name", "str"),
+    ("phone_number", "Phone", "str"),
+    ("purchase_time", "Purchase Time", "timestamp"),
+    ("telegram_id", "Telegram ID", "int"),
+    ("qr_string", "QR String", "str"),
+]
+
+
+def unavailable_reason(fmt):
+    """Returns why `fmt` can't be exported right now, or None if it can."""
+    if fmt not in FORMATS:
+        return f"Unknown export format '{fmt}' (choose from: {', '.join(FORMATS)})"
+    if FORMATS[fmt][2] and pa is None:
+        return f"The {fmt} export requires the 'pyarrow' package (pip install pyarrow)"
+    return None
+
+
+def stream(fmt, columns, batches):
+    """Yields the export file in chunks (str for text formats, bytes for columnar ones)."""
+    writers = {"csv": stream_csv, "ndjson": stream_ndjson, "parquet": stream_parquet, "arrow": stream_arrow}
+    return writers[fmt](columns, batches)
+
+
+# --- Value typing ---
+
+def _parse(value, kind):
+    """Converts a raw SQLite value to the column's type (None if it doesn't parse)."""
+    if value is None or value == "":
+        return None
+    try:
+        if kind == "int":
+            return int(value)
+        if kind == "float":
+            return float(value)
+        if kind == "date":
+            return date.fromisoformat(str(value)[:10])
+        if kind == "timestamp":
+            return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    return str(value)
+
+def _typed_rows(columns, batch):
+    return [{key: _parse(row.get(key), kind) for key, _, kind in columns} for row in batch]
+
+
+# --- Text formats ---
+
+def stream_csv(columns, batches):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return chunk
+
+    writer.writerow([header for _, header, _ in columns])
+    yield flush()  # The download starts before the first query finishes
+    for batch in batches:
+        writer.writerows([row.get(key) for key, _, _ in columns] for row in batch)
+        yield flush()
+
+def stream_ndjson(columns, batches):
+    for batch in batches:
+        yield "".join(
+            json.dumps(row, default=lambda v: v.isoformat(), ensure_ascii=False) + "\n"
+            for row in _typed_rows(columns, batch)
+        )
+
+
+# --- Columnar formats (pyarrow) ---
+
+def _arrow_schema(columns):
+    types = {
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "str": pa.string(),
+        "date": pa.date32(),
+        "timestamp": pa.timestamp("s"),
+    }
+    return pa.schema([(key, types[kind]) for key, _, kind in columns])
+
+def _record_batch(schema, columns, batch):
+    return pa.RecordBatch.from_pylist(_typed_rows(columns, batch), schema=schema)
+
+class _ChunkSink:
+    """Write-only file object that hands out what was written since the last drain()."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+def stream_arrow(columns, batches):
+    schema = _arrow_schema(columns)
+    sink = _ChunkSink()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        yield sink.drain()
+        for batch in batches:
+            writer.write_batch(_record_batch(schema, columns, batch))
+            yield sink.drain()
+    yield sink.drain()  # End-of-stream marker
+
+def stream_parquet(columns, batches):
+    schema = _arrow_schema(columns)
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(_record_batch(schema, columns, batch))
+            yield sink.drain()
+    yield sink.drain()  # Footer (schema + row group index)
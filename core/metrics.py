@@ -0,0 +1,249 @@
+"""
+In-process metrics in the Prometheus text format (served by GET /metrics).
+
+* HTTP: MetricsMiddleware records a latency histogram per (method, route template)
+  and a request counter per (method, route, status).
+* Dependencies: one latency histogram + call counter labelled by dependency
+  (stripe / telegram / qr / db) and operation. Use timer() around a call,
+  observe() when the timing is already known, or instrument_module() to time
+  every public function of a module (db_manager).
+* Collectors: callables returning extra gauges at scrape time (pool sizes, ...).
+
+The hot path is a perf_counter() pair, a bisect and a short lock per
+observation. Every worker process keeps its own numbers (scrape each one,
+or run a single worker).
+"""
+import os
+import time
+import bisect
+import inspect
+import functools
+import threading
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+
+# Seconds; covers 1 ms SQLite reads up to slow Stripe / Telegram round trips
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}  # label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_labels_text(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self._series.items())
+        names = self.labelnames + ("le",)
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels_text(names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels_text(self.labelnames, labels)} {count}")
+        return lines
+
+
+HTTP_LATENCY = Histogram(
+    "partyflow_http_request_duration_seconds", "HTTP request latency by route", ("method", "route")
+)
+HTTP_REQUESTS = Counter(
+    "partyflow_http_requests_total", "HTTP requests by route and status code", ("method", "route", "status")
+)
+DEPENDENCY_LATENCY = Histogram(
+    "partyflow_dependency_duration_seconds", "Latency of calls to Stripe, Telegram, QR rendering and the DB",
+    ("dependency", "operation")
+)
+DEPENDENCY_CALLS = Counter(
+    "partyflow_dependency_calls_total", "Calls to Stripe, Telegram, QR rendering and the DB by outcome",
+    ("dependency", "operation", "outcome")
+)
+
+_metrics = [HTTP_LATENCY, HTTP_REQUESTS, DEPENDENCY_LATENCY, DEPENDENCY_CALLS]
+_collectors = []  # (name, help, label name, collect) gauge families, read at scrape time
+
+
+# --- Dependencies ---
+
+def observe(dependency, operation, seconds, ok=True):
+    """Records one dependency call that took `seconds`."""
+    if not METRICS_ENABLED:
+        return
+    DEPENDENCY_LATENCY.observe((dependency, operation), seconds)
+    DEPENDENCY_CALLS.inc((dependency, operation, "ok" if ok else "error"))
+
+@contextmanager
+def timer(dependency, operation):
+    """Times the `with` block; an exception counts as an error."""
+    started = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        observe(dependency, operation, time.perf_counter() - started, ok)
+
+def timed(dependency, operation, func):
+    """Wraps a function (sync, async or generator) so every call is timed."""
+    # Timing is inlined rather than using timer(): these wrappers sit on every DB call
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            started, ok = time.perf_counter(), False
+            try:
+                result = await func(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                observe(dependency, operation, time.perf_counter() - started, ok)
+        return async_wrapper
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            # The call is the time spent inside the generator, summed over every item and observed
+            # once it closes; the consumer's time between items (a client downloading an export) isn't
+            generator = func(*args, **kwargs)
+            elapsed, ok = 0.0, False
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        ok = True
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - started
+                    yield item
+            finally:
+                started = time.perf_counter()
+                generator.close()
+                elapsed += time.perf_counter() - started
+                observe(dependency, operation, elapsed, ok)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started, ok = time.perf_counter(), False
+        try:
+            result = func(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            observe(dependency, operation, time.perf_counter() - started, ok)
+    return wrapper
+
+def instrument_module(module, dependency, exclude=()):
+    """Replaces every public function defined in `module` with a timed version (once)."""
+    if not METRICS_ENABLED:
+        return
+    for name, func in list(vars(module).items()):
+        if (name.startswith("_") or name in exclude or not inspect.isfunction(func)
+                or func.__module__ != module.__name__ or getattr(func, "__wrapped__", None)):
+            continue
+        setattr(module, name, timed(dependency, name, func))
+
+
+# --- HTTP ---
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: latency + status per route template (/api/tickets/{user_id},
+    not every user ID), measured until the last body chunk is sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            labels = (scope["method"], getattr(route, "path", None) or "unmatched")
+            HTTP_LATENCY.observe(labels, time.perf_counter() - started)
+            HTTP_REQUESTS.inc(labels + (str(status[0]),))
+
+
+# --- Exposition ---
+
+def register_collector(name, documentation, label, collect):
+    """Adds a gauge family read at scrape time: collect() -> {label value: number}."""
+    _collectors.append((name, documentation, label, collect))
+
+def render():
+    """All metrics in the Prometheus text format (version 0.0.4)."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for name, documentation, label, collect in _collectors:
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+        for value_label, value in sorted(collect().items()):
+            if isinstance(value, (int, float)):
+                lines.append(f"{name}{_labels_text((label,), (value_label,))} {_number(value)}")
+    return "\n".join(lines) + "\n"
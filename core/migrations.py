@@ -0,0 +1,295 @@
+"""
+Versioned schema migrations for the PartyFlow SQLite database.
+
+The current schema version is stored in SQLite's built-in `PRAGMA user_version`.
+Each migration runs once, in order, inside the same write transaction that bumps
+the version, so several API workers starting together can't apply it twice.
+
+To change the schema: append a new function to MIGRATIONS (never edit old ones).
+"""
+
+
+def _columns(cursor, table):
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+def _add_column_if_missing(cursor, table, column, definition):
+    if column not in _columns(cursor, table):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+# --- Migrations ---
+
+def m001_base_schema(cursor):
+    """Events & tickets tables (reconciles databases made by database/create_db.py)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            date TEXT NOT NULL,
+            location TEXT NOT NULL,
+            price REAL NOT NULL,
+            total_tickets INTEGER NOT NULL,
+            is_active INTEGER DEFAULT 1
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_name TEXT,
+            phone_number TEXT,
+            purchase_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(event_id) REFERENCES events(id)
+        )
+    ''')
+
+    # The legacy create_db.py schema had no is_active flag and stored
+    # tickets with (status, purchase_date, ticket_hash) instead of the buyer details
+    _add_column_if_missing(cursor, "events", "is_active", "INTEGER DEFAULT 1")
+    _add_column_if_missing(cursor, "tickets", "user_name", "TEXT")
+    _add_column_if_missing(cursor, "tickets", "phone_number", "TEXT")
+    if "purchase_time" not in _columns(cursor, "tickets"):
+        cursor.execute("ALTER TABLE tickets ADD COLUMN purchase_time TIMESTAMP")
+        cursor.execute("UPDATE tickets SET purchase_time = COALESCE(purchase_date, CURRENT_TIMESTAMP)")
+
+def m002_sales_counters(cursor):
+    """Denormalized sold_count / revenue on events, backfilled from tickets."""
+    columns = _columns(cursor, "events")
+    if "sold_count" in columns and "revenue" in columns:
+        return
+
+    _add_column_if_missing(cursor, "events", "sold_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column_if_missing(cursor, "events", "revenue", "REAL NOT NULL DEFAULT 0")
+    cursor.execute('''
+        UPDATE events
+        SET sold_count = (SELECT COUNT(*) FROM tickets t WHERE t.event_id = events.id),
+            revenue = price * (SELECT COUNT(*) FROM tickets t WHERE t.event_id = events.id)
+    ''')
+
+def m003_hot_query_indexes(cursor):
+    """Secondary indexes for the per-request lookups."""
+    # Attendee lists & capacity (covering: event_id -> user_id)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_event_user ON tickets(event_id, user_id)")
+    # /my_tickets (covering: user_id -> event_id)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_user_event ON tickets(user_id, event_id)")
+    # Active/archived lists (is_active + implicit rowid: id order for pagination) & daily reminders (is_active, date)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_active ON events(is_active)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_active_date ON events(is_active, date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_name ON events(name)")
+    # Top event
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_sold_count ON events(sold_count)")
+
+def m004_ticket_order_id(cursor):
+    """Links tickets to the checkout that issued them (idempotent fulfillment)."""
+    _add_column_if_missing(cursor, "tickets", "order_id", "TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_order ON tickets(order_id)")
+
+def m005_ticket_holds(cursor):
+    """Checkout reservations: seats held until payment, release or timeout."""
+    _add_column_if_missing(cursor, "events", "held_count", "INTEGER NOT NULL DEFAULT 0")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_holds (
+            id TEXT PRIMARY KEY,
+            event_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'held',
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY(event_id) REFERENCES events(id)
+        )
+    ''')
+    # Expiry sweeps only touch live holds
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_holds_status_expires ON ticket_holds(status, expires_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_holds_event_status ON ticket_holds(event_id, status, expires_at)")
+
+def m006_broadcasts(cursor):
+    """Broadcast jobs with a persisted delivery status per recipient."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            total INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at REAL,
+            PRIMARY KEY (broadcast_id, chat_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status ON broadcast_recipients(broadcast_id, status)")
+
+def m007_scheduled_jobs(cursor):
+    """Idempotent reminders (dedupe key per broadcast) and cross-worker job locks."""
+    _add_column_if_missing(cursor, "broadcasts", "dedupe_key", "TEXT")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_broadcasts_dedupe ON broadcasts(dedupe_key)")
+    # Recipients are streamed in chat_id order per status
+    cursor.execute("DROP INDEX IF EXISTS idx_broadcast_recipients_status")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status ON broadcast_recipients(broadcast_id, status, chat_id)"
+    )
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_locks (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+def m008_ticket_media(cursor):
+    """Telegram file_id of every uploaded ticket image, so repeat sends skip the upload."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_media (
+            ticket_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (ticket_id, kind)
+        ) WITHOUT ROWID
+    ''')
+
+def m009_user_ticket_pages(cursor):
+    """Keyset pagination of /my_tickets (user_id -> ticket id order)."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_user_id ON tickets(user_id, id)")
+
+def m010_catalog_version(cursor):
+    """
+    Version number of the public event catalog, bumped by triggers whenever an
+    event is added, edited, archived or restored (not on ticket sales).
+    Lets /events answer conditional requests without re-reading the catalog.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    now = "(julianday('now') - 2440587.5) * 86400.0"  # Unix time, like time.time()
+    cursor.execute(f"INSERT OR IGNORE INTO catalog_meta (id, version, updated_at) VALUES (1, 1, {now})")
+    bump = f"UPDATE catalog_meta SET version = version + 1, updated_at = {now}"
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_catalog_insert AFTER INSERT ON events BEGIN {bump}; END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_catalog_delete AFTER DELETE ON events BEGIN {bump}; END")
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_catalog_update
+        AFTER UPDATE OF name, date, location, price, total_tickets, is_active ON events
+        BEGIN {bump}; END
+    ''')
+
+def m011_bot_sessions(cursor):
+    """Purchase-flow state of bot chats (BOT_STATE_BACKEND=sqlite)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_sessions (
+            chat_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_sessions_expires ON bot_sessions(expires_at)")
+
+def m012_export_indexes(cursor):
+    """Guest list export of one event, newest ticket first (keyset on ticket id)."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_event_id ON tickets(event_id, id)")
+
+def m013_events_fts(cursor):
+    """
+    Full-text index over event name + location for the dashboard search.
+    External-content FTS5 table (no copy of the text), kept in sync by triggers.
+    """
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(
+            name, location, content='events', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_events_fts_insert AFTER INSERT ON events BEGIN
+            INSERT INTO events_fts(rowid, name, location) VALUES (new.id, new.name, new.location);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_events_fts_delete AFTER DELETE ON events BEGIN
+            INSERT INTO events_fts(events_fts, rowid, name, location) VALUES ('delete', old.id, old.name, old.location);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_events_fts_update AFTER UPDATE OF name, location ON events BEGIN
+            INSERT INTO events_fts(events_fts, rowid, name, location) VALUES ('delete', old.id, old.name, old.location);
+            INSERT INTO events_fts(rowid, name, location) VALUES (new.id, new.name, new.location);
+        END
+    ''')
+    # Index the events that already exist
+    cursor.execute("INSERT INTO events_fts(events_fts) VALUES ('rebuild')")
+
+def m014_events_active_id_index(cursor):
+    """
+    Keyset pages (is_active = ? AND id > ? ORDER BY id) need events in (is_active, id)
+    order; idx_events_active_date is in date order and would sort every row of the status.
+    Spelled out explicitly, replacing the implicit-rowid idx_events_active.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_active_id ON events(is_active, id)")
+    cursor.execute("DROP INDEX IF EXISTS idx_events_active")
+
+
+MIGRATIONS = [
+    m001_base_schema,
+    m002_sales_counters,
+    m003_hot_query_indexes,
+    m004_ticket_order_id,
+    m005_ticket_holds,
+    m006_broadcasts,
+    m007_scheduled_jobs,
+    m008_ticket_media,
+    m009_user_ticket_pages,
+    m010_catalog_version,
+    m011_bot_sessions,
+    m012_export_indexes,
+    m013_events_fts,
+    m014_events_active_id_index,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+# --- Runner ---
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    """
+    Applies every pending migration on the given connection.
+    Returns the list of migration names that were applied.
+    """
+    if get_version(conn) >= LATEST_VERSION:
+        return []
+
+    applied = []
+    cursor = conn.cursor()
+    # Take the write lock first, then re-read the version (another process may have migrated)
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        version = get_version(conn)
+        for number, migration in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number}")
+            applied.append(migration.__name__)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
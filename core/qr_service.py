@@ -0,0 +1,162 @@
+"""
+QR code rendering service shared by the API and the bot.
+
+* PNG bytes are cached in memory (LRU, bounded by total bytes) keyed by payload.
+* Optionally (QR_STORE_DIR) PNGs are also kept on disk under the SHA-256 of the
+  payload, so a restart doesn't have to re-render them. The store evicts the
+  least recently used files once it grows past QR_STORE_MAX_BYTES.
+* render_many() / render_many_async() render only the cache misses, in parallel.
+"""
+import os
+import asyncio
+import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import qrcode
+
+from core import metrics
+
+QR_CACHE_MAX_BYTES = int(os.getenv("QR_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+QR_STORE_DIR = os.getenv("QR_STORE_DIR", "")  # Empty -> disk store disabled
+QR_STORE_MAX_BYTES = int(os.getenv("QR_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+QR_WORKERS = int(os.getenv("QR_WORKERS", "4"))
+
+# CPU-bound rendering runs here instead of on the event loop / bot thread
+executor = ThreadPoolExecutor(max_workers=QR_WORKERS, thread_name_prefix="qr")
+
+_cache = OrderedDict()  # payload -> PNG bytes
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+_store_bytes = None     # Lazily measured size of the disk store
+_store_lock = threading.Lock()
+_stats = {"hits": 0, "disk_hits": 0, "renders": 0}
+
+
+# --- In-memory LRU ---
+
+def _cache_get(payload):
+    with _cache_lock:
+        png = _cache.get(payload)
+        if png is not None:
+            _cache.move_to_end(payload)
+            _stats["hits"] += 1
+        return png
+
+def _cache_put(payload, png):
+    global _cache_bytes
+    with _cache_lock:
+        if payload in _cache:
+            return
+        _cache[payload] = png
+        _cache_bytes += len(png)
+        while _cache_bytes > QR_CACHE_MAX_BYTES and _cache:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= len(evicted)
+
+
+# --- Content-addressed disk store ---
+
+def _store_path(payload):
+    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    return os.path.join(QR_STORE_DIR, digest[:2], f"{digest}.png")
+
+def _store_get(payload):
+    path = _store_path(payload)
+    try:
+        with open(path, "rb") as f:
+            png = f.read()
+    except OSError:
+        return None
+    os.utime(path)  # Mark as recently used for eviction
+    _stats["disk_hits"] += 1
+    return png
+
+def _store_files():
+    for root, _, files in os.walk(QR_STORE_DIR):
+        for name in files:
+            if name.endswith(".png"):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+def _store_put(payload, png):
+    global _store_bytes
+    path = _store_path(payload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(png)
+    os.replace(tmp_path, path)  # Atomic: readers never see half-written files
+
+    with _store_lock:
+        if _store_bytes is None:
+            _store_bytes = sum(size for _, size, _ in _store_files())
+        else:
+            _store_bytes += len(png)
+        if _store_bytes > QR_STORE_MAX_BYTES:
+            _evict_store()
+
+def _evict_store():
+    """Deletes least recently used files until the store is at 90% of its limit."""
+    global _store_bytes
+    files = sorted(_store_files(), key=lambda f: f[2])
+    _store_bytes = sum(size for _, size, _ in files)
+    target = QR_STORE_MAX_BYTES * 0.9
+    for path, size, _ in files:
+        if _store_bytes <= target:
+            break
+        try:
+            os.remove(path)
+            _store_bytes -= size
+        except OSError:
+            pass
+
+
+# --- Public API ---
+
+def _render(payload):
+    with metrics.timer("qr", "render"):
+        img = qrcode.make(payload)
+        bio = BytesIO()
+        img.save(bio, "PNG")
+    _stats["renders"] += 1
+    return bio.getvalue()
+
+def render_png(payload):
+    """Returns the PNG bytes of a QR code for `payload` (cached)."""
+    png = _cache_get(payload)
+    if png is not None:
+        return png
+
+    png = _store_get(payload) if QR_STORE_DIR else None
+    if png is None:
+        png = _render(payload)
+        if QR_STORE_DIR:
+            _store_put(payload, png)
+
+    _cache_put(payload, png)
+    return png
+
+def render_many(payloads):
+    """Renders a batch (cache misses in parallel on the QR pool). Returns PNGs in order."""
+    unique = list(dict.fromkeys(payloads))
+    pngs = dict(zip(unique, executor.map(render_png, unique)))
+    return [pngs[p] for p in payloads]
+
+async def render_many_async(payloads):
+    """Async version of render_many() for the API's event loop."""
+    loop = asyncio.get_running_loop()
+    unique = list(dict.fromkeys(payloads))
+    results = await asyncio.gather(*[loop.run_in_executor(executor, render_png, p) for p in unique])
+    pngs = dict(zip(unique, results))
+    return [pngs[p] for p in payloads]
+
+def get_stats():
+    with _cache_lock:
+        return {**_stats, "cached_items": len(_cache), "cached_bytes": _cache_bytes}
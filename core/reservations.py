@@ -0,0 +1,173 @@
+"""
+Checkout reservations (holds).
+
+When a buyer opens a Stripe checkout, their seats are held against the event's
+capacity (events.held_count) until one of:
+  * payment succeeds  -> convert_hold() turns the hold into tickets
+  * payment is canceled -> release_hold()
+  * the hold times out -> release_expired_holds() (scheduler) or lazily on the next hold
+
+Every state change is a single short BEGIN IMMEDIATE transaction, so thousands
+of concurrent checkouts against one event queue on SQLite's write lock instead
+of overselling.
+"""
+import os
+import secrets
+import time
+
+from core import db_manager
+
+# How long a checkout may keep seats reserved
+HOLD_TTL_SECONDS = int(os.getenv("HOLD_TTL_SECONDS", "1800"))
+
+# Finished holds are kept this long for debugging, then purged
+FINISHED_HOLD_RETENTION = 24 * 60 * 60
+
+
+def _release_expired(cursor, now, event_id=None):
+    """Returns expired holds' seats to capacity (inside the caller's transaction)."""
+    where = "status = 'held' AND expires_at <= ?"
+    params = [now]
+    if event_id is not None:
+        where += " AND event_id = ?"
+        params.append(event_id)
+
+    expired = cursor.execute(
+        f"SELECT event_id, SUM(quantity) FROM ticket_holds WHERE {where} GROUP BY event_id", params
+    ).fetchall()
+    for expired_event_id, quantity in expired:
+        cursor.execute(
+            "UPDATE events SET held_count = MAX(held_count - ?, 0) WHERE id = ?",
+            (quantity, expired_event_id)
+        )
+    cursor.execute(f"UPDATE ticket_holds SET status = 'expired' WHERE {where}", params)
+    return sum(quantity for _, quantity in expired)
+
+
+def create_hold(event_id, user_id, quantity, ttl=HOLD_TTL_SECONDS):
+    """
+    Reserves `quantity` seats for a checkout.
+    Returns the hold dict (id, event_id, quantity, expires_at), or None if there aren't enough seats.
+    """
+    if quantity < 1:
+        # A negative hold would add phantom capacity
+        raise ValueError(f"Hold quantity must be at least 1, got {quantity}")
+    now = time.time()
+    hold_id = secrets.token_urlsafe(16)
+
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Seats from abandoned checkouts go back on sale before we check capacity
+            _release_expired(cursor, now, event_id)
+
+            cursor.execute('''
+                UPDATE events
+                SET held_count = held_count + ?
+                WHERE id = ? AND is_active = 1 AND sold_count + held_count + ? <= total_tickets
+            ''', (quantity, event_id, quantity))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return None
+
+            cursor.execute('''
+                INSERT INTO ticket_holds (id, event_id, user_id, quantity, status, created_at, expires_at)
+                VALUES (?, ?, ?, ?, 'held', ?, ?)
+            ''', (hold_id, event_id, user_id, quantity, now, now + ttl))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    return {"id": hold_id, "event_id": event_id, "quantity": quantity, "expires_at": now + ttl}
+
+
+def release_hold(hold_id):
+    """Gives a live hold's seats back (e.g. payment canceled). Returns True if something was released."""
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            hold = cursor.execute(
+                "SELECT event_id, quantity FROM ticket_holds WHERE id = ? AND status = 'held'", (hold_id,)
+            ).fetchone()
+            if not hold:
+                conn.rollback()
+                return False
+
+            cursor.execute(
+                "UPDATE events SET held_count = MAX(held_count - ?, 0) WHERE id = ?",
+                (hold["quantity"], hold["event_id"])
+            )
+            cursor.execute("UPDATE ticket_holds SET status = 'released' WHERE id = ?", (hold_id,))
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def convert_hold(hold_id, user, order_id=None):
+    """
+    Turns a paid hold into tickets (held seats -> sold seats) in one transaction.
+    Calling it again for the same hold returns the same ticket IDs.
+    Returns (ticket IDs, created): created is False when an earlier call already
+    converted the hold. Ticket IDs are None if the hold is unknown / already released.
+    """
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            hold = cursor.execute(
+                "SELECT event_id, quantity, status FROM ticket_holds WHERE id = ?", (hold_id,)
+            ).fetchone()
+
+            if hold and hold["status"] == "converted" and order_id:
+                existing = cursor.execute(
+                    "SELECT id FROM tickets WHERE order_id = ? ORDER BY id", (order_id,)
+                ).fetchall()
+                conn.rollback()
+                return [row[0] for row in existing], False
+
+            # A 'held' hold past its expiry still owns its seats until swept, so it is honored
+            if not hold or hold["status"] != "held":
+                conn.rollback()
+                return None, False
+
+            cursor.execute('''
+                UPDATE events
+                SET held_count = MAX(held_count - ?, 0),
+                    sold_count = sold_count + ?,
+                    revenue = revenue + price * ?
+                WHERE id = ?
+            ''', (hold["quantity"], hold["quantity"], hold["quantity"], hold["event_id"]))
+
+            ticket_ids = db_manager.insert_ticket_rows(
+                cursor, hold["event_id"], user, hold["quantity"], order_id
+            )
+            cursor.execute("UPDATE ticket_holds SET status = 'converted' WHERE id = ?", (hold_id,))
+            conn.commit()
+            return ticket_ids, True
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def release_expired_holds():
+    """Scheduler job: frees seats of timed-out checkouts. Returns the number of seats released."""
+    now = time.time()
+    with db_manager.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            released = _release_expired(cursor, now)
+            cursor.execute(
+                "DELETE FROM ticket_holds WHERE status != 'held' AND expires_at <= ?",
+                (now - FINISHED_HOLD_RETENTION,)
+            )
+            conn.commit()
+            return released
+        except Exception:
+            conn.rollback()
+            raise
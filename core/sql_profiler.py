@@ -0,0 +1,241 @@
+"""
+Opt-in SQL profiler for db_manager (SQL_PROFILE=1).
+
+With profiling on, the connection pool opens its connections with
+ProfilingConnection, whose cursors time every statement (execute + fetch)
+while a profile is active. SQLProfilerMiddleware starts one profile per HTTP
+request, and profile() does the same for scripts. A profile:
+
+* counts queries and total DB time
+* logs statements slower than SQL_SLOW_MS, with their EXPLAIN QUERY PLAN
+* flags statements run SQL_N_PLUS_ONE+ times (same SQL, any parameters) as
+  N+1 suspects - usually a query inside a loop that should be one batch query
+
+Admins (session cookie) get the request's numbers in the X-SQL-Profile and
+X-SQL-N-Plus-One response headers. With SQL_PROFILE off, connections are plain
+sqlite3 connections and nothing here runs.
+"""
+import os
+import time
+import logging
+import sqlite3
+import contextvars
+from contextlib import contextmanager
+
+SQL_PROFILE = os.getenv("SQL_PROFILE", "0") == "1"
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "50"))
+SQL_N_PLUS_ONE = int(os.getenv("SQL_N_PLUS_ONE", "5"))
+# Parameters hold user IDs, names and phone numbers: only their types are logged unless this is on
+SQL_LOG_PARAMS = os.getenv("SQL_LOG_PARAMS", "0") == "1"
+
+# Slow statements kept per profile (all of them are logged)
+MAX_SLOW_RECORDS = 20
+HEADER_SQL_LENGTH = 80
+
+# Copied into worker threads (run_in_threadpool, db_async), so sync routes and async DB calls are profiled too
+_current = contextvars.ContextVar("sql_profile", default=None)
+
+
+class Profile:
+
+    def __init__(self, name=""):
+        self.name = name
+        self.queries = 0
+        self.seconds = 0.0
+        self.statements = {}  # sql -> [count, seconds]
+        self.slow = []        # (ms, sql, plan)
+
+    def n_plus_one(self):
+        """[(sql, count)] of statements repeated often enough to be N+1 suspects, most repeated first."""
+        suspects = [(sql, stats[0]) for sql, stats in self.statements.items()
+                    if stats[0] >= SQL_N_PLUS_ONE and sql.lstrip()[:6].upper() in ("SELECT", "WITH")]
+        return sorted(suspects, key=lambda suspect: -suspect[1])
+
+    def summary(self):
+        return {
+            "queries": self.queries,
+            "time_ms": round(self.seconds * 1000, 2),
+            "n_plus_one": [{"sql": sql, "count": count} for sql, count in self.n_plus_one()],
+            "slow": [{"ms": ms, "sql": sql, "plan": plan} for ms, sql, plan in self.slow],
+        }
+
+    def headers(self):
+        """Debug response headers (ASCII, one line each)."""
+        headers = [(
+            b"x-sql-profile",
+            f"queries={self.queries}; time_ms={self.seconds * 1000:.2f}; slow={len(self.slow)}".encode(),
+        )]
+        suspects = self.n_plus_one()
+        if suspects:
+            text = " | ".join(f"{count}x {_one_line(sql)[:HEADER_SQL_LENGTH]}" for sql, count in suspects)
+            headers.append((b"x-sql-n-plus-one", text.encode("ascii", "replace")))
+        return headers
+
+    def log(self):
+        """Warns about N+1 suspects (slow statements are logged as they happen)."""
+        for sql, count in self.n_plus_one():
+            logging.warning(f"🔁 N+1 suspect in {self.name}: {count}x {_one_line(sql)}")
+
+
+class _Statement:
+    """Timing of one executed statement, accumulated over execute + fetches."""
+
+    def __init__(self, profile, sql, parameters):
+        self.profile = profile
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = 0.0
+        self.logged = False
+
+
+def _one_line(sql):
+    return " ".join(sql.split())
+
+def _describe_parameters(parameters):
+    """The parameters as logged: verbatim with SQL_LOG_PARAMS=1, otherwise just their types."""
+    if SQL_LOG_PARAMS or parameters is None:
+        return repr(parameters)
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{name}: {type(value).__name__}" for name, value in parameters.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+
+def _explain(conn, sql, parameters):
+    try:
+        rows = sqlite3.Connection.execute(conn, f"EXPLAIN QUERY PLAN {sql}", parameters or ()).fetchall()
+    except (sqlite3.Error, ValueError):
+        return "n/a"
+    return "; ".join(row[-1] for row in rows)
+
+
+class ProfilingCursor(sqlite3.Cursor):
+
+    _statement = None
+
+    def execute(self, sql, parameters=()):
+        profile = _current.get()
+        if profile is None:
+            self._statement = None
+            return super().execute(sql, parameters)
+        self._statement = _Statement(profile, sql, parameters)
+        profile.queries += 1
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._account(started)
+
+    def executemany(self, sql, seq_of_parameters):
+        profile = _current.get()
+        if profile is None:
+            self._statement = None
+            return super().executemany(sql, seq_of_parameters)
+        self._statement = _Statement(profile, sql, None)
+        profile.queries += 1
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._account(started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._account(started, fetch=True)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(size) if size is not None else super().fetchmany()
+        finally:
+            self._account(started, fetch=True)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._account(started, fetch=True)
+
+    def _account(self, started, fetch=False):
+        statement = self._statement
+        if statement is None:
+            return
+        elapsed = time.perf_counter() - started
+        statement.seconds += elapsed
+        profile = statement.profile
+        profile.seconds += elapsed
+        stats = profile.statements.setdefault(statement.sql, [0, 0.0])
+        if not fetch:
+            stats[0] += 1
+        stats[1] += elapsed
+
+        if not statement.logged and statement.seconds * 1000 >= SQL_SLOW_MS:
+            statement.logged = True
+            ms = round(statement.seconds * 1000, 2)
+            plan = _explain(self.connection, statement.sql, statement.parameters)
+            if len(profile.slow) < MAX_SLOW_RECORDS:
+                profile.slow.append((ms, _one_line(statement.sql), plan))
+            logging.warning(
+                f"🐢 Slow query ({ms} ms) in {profile.name}: {_one_line(statement.sql)} "
+                f"| params={_describe_parameters(statement.parameters)} | plan: {plan}"
+            )
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """sqlite3 connection whose cursors report to the active profile."""
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or ProfilingCursor)
+
+    # Connection.execute() would otherwise create and run a plain cursor in C
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    """What db_manager should open connections with."""
+    return ProfilingConnection if SQL_PROFILE else sqlite3.Connection
+
+@contextmanager
+def profile(name="script"):
+    """Profiles the DB work done inside the `with` block (this context / its worker threads)."""
+    current = Profile(name)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        current.log()
+
+
+class SQLProfilerMiddleware:
+    """ASGI middleware: one profile per HTTP request, debug headers for admins."""
+
+    def __init__(self, app, is_admin):
+        self.app = app
+        self.is_admin = is_admin  # is_admin(scope) -> bool
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not SQL_PROFILE:
+            return await self.app(scope, receive, send)
+
+        current = Profile(f"{scope['method']} {scope['path']}")
+        show_headers = self.is_admin(scope)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and show_headers:
+                # Streaming responses may still query after this point; the header has what ran so far
+                message = {**message, "headers": list(message.get("headers", [])) + current.headers()}
+            await send(message)
+
+        token = _current.set(current)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            current.log()
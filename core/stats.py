@@ -0,0 +1,163 @@
+"""
+Dashboard sales stats (revenue, tickets sold, top events).
+
+Instead of aggregating over every event on each /dashboard or /api/stats hit,
+the process keeps a materialized snapshot and serves it from memory:
+
+* Reads return the snapshot as long as it is younger than STATS_MAX_STALENESS_SECONDS.
+* After that (or after invalidate(), called on ticket sales / archive / restore in
+  this process) the next read refreshes it incrementally: only events that sold
+  tickets since the last refresh are re-read (a range on the tickets primary key).
+* A change of the catalog version (event added, edited, archived or restored by any
+  worker) only re-reads the top events, since it never changes sales counters.
+* Every STATS_FULL_RECOMPUTE_SECONDS a full recompute repairs anything the
+  increments can't see (e.g. rebuild_sales_counters()).
+
+A refresh costs O(events that changed + top N), never O(all events), apart from
+that periodic recompute.
+
+Every refresh re-reads the stored counters of the touched events instead of adding
+up deltas, so a sale can never be counted twice.
+"""
+import os
+import time
+import threading
+
+from core import db_manager, db_async
+
+STATS_MAX_STALENESS = float(os.getenv("STATS_MAX_STALENESS_SECONDS", "5"))
+STATS_FULL_RECOMPUTE = float(os.getenv("STATS_FULL_RECOMPUTE_SECONDS", "300"))
+STATS_TOP_N = int(os.getenv("STATS_TOP_N", "5"))
+
+
+class StatsSnapshot:
+
+    def __init__(self, top_n=STATS_TOP_N):
+        self.top_n = top_n
+        self.sales = {}            # event_id -> (sold_count, revenue), to turn re-read counters into deltas
+        self.total_revenue = 0.0
+        self.tickets_sold = 0
+        self.top = []              # Up to top_n (sold_count, event_id), best first
+        self.names = {}            # event_id -> name, for the events in self.top
+        self.last_ticket_id = 0
+        self.db_name = None
+        self.catalog_version = None
+        self.refreshed_at = 0.0    # monotonic
+        self.recomputed_at = 0.0   # monotonic
+        self.view = None           # What get_snapshot() hands out (built once per refresh)
+
+    def recompute(self, catalog_version):
+        """Rebuilds everything from the events' stored counters."""
+        # Read the ticket high-water mark first: a sale in between is then seen twice (harmless), never zero times
+        self.last_ticket_id = db_manager.get_last_ticket_id()
+        events = db_manager.get_event_sales()
+        self.sales = {event["id"]: (event["sold_count"], event["revenue"] or 0) for event in events}
+        self.total_revenue = sum(revenue for _, revenue in self.sales.values())
+        self.tickets_sold = sum(sold for sold, _ in self.sales.values())
+        self.top = sorted(
+            ((sold, event_id) for event_id, (sold, _) in self.sales.items() if sold > 0),
+            key=lambda entry: (-entry[0], entry[1]),
+        )[:self.top_n]
+        top_ids = {event_id for _, event_id in self.top}
+        self.names = {event["id"]: event["name"] for event in events if event["id"] in top_ids}
+        self.db_name = db_manager.DB_NAME
+        self.catalog_version = catalog_version
+        self.recomputed_at = time.monotonic()
+
+    def apply_sales(self):
+        """Re-reads only the events that sold tickets since the last refresh."""
+        sales = db_manager.get_sales_since(self.last_ticket_id)
+        if not sales:
+            return
+        self.last_ticket_id = max(self.last_ticket_id, *sales.values())
+        for event in db_manager.get_event_sales(sales):
+            sold, revenue = event["sold_count"], event["revenue"] or 0
+            old_sold, old_revenue = self.sales.get(event["id"], (0, 0))
+            self.total_revenue += revenue - old_revenue
+            self.tickets_sold += sold - old_sold
+            self.sales[event["id"]] = (sold, revenue)
+            self._update_top(event["id"], sold, event["name"])
+
+    def apply_catalog_change(self, catalog_version):
+        """
+        Events were added, edited, archived or restored. New events have no sales
+        and the counters aren't touched, so only the top events are re-read (names,
+        deleted rows); anything else is left to the periodic full recompute.
+        """
+        events = {event["id"]: event for event in db_manager.get_event_sales([e for _, e in self.top])}
+        for _, event_id in self.top:
+            if event_id not in events:
+                sold, revenue = self.sales.pop(event_id)
+                self.total_revenue -= revenue
+                self.tickets_sold -= sold
+        self.top = [entry for entry in self.top if entry[1] in events]
+        self.names = {event_id: events[event_id]["name"] for _, event_id in self.top}
+        self.catalog_version = catalog_version
+
+    def _update_top(self, event_id, sold_count, name):
+        # Sales only grow between recomputes, so an event outside the top can only move in
+        top = [entry for entry in self.top if entry[1] != event_id]
+        if sold_count > 0:
+            top.append((sold_count, event_id))
+        self.top = sorted(top, key=lambda entry: (-entry[0], entry[1]))[:self.top_n]
+        self.names[event_id] = name
+        self.names = {top_id: self.names[top_id] for _, top_id in self.top}
+
+    def build_view(self):
+        top_events = [
+            {"id": event_id, "name": self.names[event_id], "sold": sold,
+             "revenue": round(self.sales[event_id][1], 2)}
+            for sold, event_id in self.top
+        ]
+        self.view = {
+            "total_revenue": round(self.total_revenue, 2),
+            "tickets_sold": self.tickets_sold,
+            "top_event": top_events[0]["name"] if top_events else "No Sales Yet",
+            "top_events": top_events,
+            "as_of": time.time(),
+        }
+        self.refreshed_at = time.monotonic()
+
+
+_snapshot = StatsSnapshot()
+_lock = threading.Lock()
+
+
+def invalidate():
+    """Makes the next read refresh the snapshot (call after sales / archive / restore)."""
+    _snapshot.refreshed_at = 0.0
+
+def refresh(full=False):
+    """Brings the snapshot up to date: incrementally, or fully when needed / forced."""
+    with _lock:
+        catalog_version = db_manager.get_catalog_version()[0]
+        if (full or _snapshot.view is None
+                or _snapshot.db_name != db_manager.DB_NAME
+                or time.monotonic() - _snapshot.recomputed_at >= STATS_FULL_RECOMPUTE):
+            _snapshot.recompute(catalog_version)
+        else:
+            if _snapshot.catalog_version != catalog_version:
+                _snapshot.apply_catalog_change(catalog_version)
+            _snapshot.apply_sales()
+        _snapshot.build_view()
+        return _snapshot.view
+
+def get_snapshot():
+    """
+    Returns the stats dict: total_revenue, tickets_sold, top_event (name),
+    top_events (top N) and as_of. Per-event sales aren't part of it; read them
+    on demand (db_manager.get_events_with_sales()).
+    Served from memory unless it is older than STATS_MAX_STALENESS_SECONDS.
+    """
+    return _fresh_view() or refresh()
+
+async def get_snapshot_async():
+    """get_snapshot() for async routes: only a refresh goes to the DB executor."""
+    return _fresh_view() or await db_async.run(refresh)
+
+def _fresh_view():
+    view = _snapshot.view
+    if view is not None and time.monotonic() - _snapshot.refreshed_at < STATS_MAX_STALENESS \
+            and _snapshot.db_name == db_manager.DB_NAME:
+        return view
+    return None
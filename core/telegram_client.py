@@ -0,0 +1,180 @@
+"""
+Shared async client for the Telegram Bot API.
+
+One aiohttp session (with a pooled TCP connector) is reused by every sender in
+the API process, and a semaphore caps how many requests are in flight at once.
+
+Sends that target a chat go through token buckets that respect Telegram's flood
+limits (about 30 messages/second per bot, 1 message/second per chat). When
+Telegram still answers 429, every sender pauses for the returned `retry_after`.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import OrderedDict
+
+import aiohttp
+
+from core import metrics
+
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+MAX_CONCURRENT_REQUESTS = int(os.getenv("TELEGRAM_MAX_CONCURRENCY", "20"))
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))      # messages / second
+PER_CHAT_RATE = float(os.getenv("TELEGRAM_PER_CHAT_RATE", "1"))   # messages / second
+MAX_TRACKED_CHATS = 10000
+REQUEST_TIMEOUT = 30
+MAX_ATTEMPTS = 5
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+_session = None
+_semaphore = None
+_global_bucket = None
+_chat_buckets = OrderedDict()  # chat_id -> TokenBucket (LRU, bounded)
+_cooldown_until = 0.0          # set from 429 retry_after
+
+
+def get_session():
+    """Returns the shared session, creating it on first use (must run inside the event loop)."""
+    global _session, _semaphore, _global_bucket
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS, ttl_dns_cache=300)
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        )
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        _global_bucket = TokenBucket(GLOBAL_RATE)
+        _chat_buckets.clear()
+    return _session
+
+
+async def close_session():
+    """Closes the shared session (app shutdown)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def _chat_bucket(chat_id):
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _chat_buckets[chat_id] = TokenBucket(PER_CHAT_RATE)
+        if len(_chat_buckets) > MAX_TRACKED_CHATS:
+            _chat_buckets.popitem(last=False)
+    else:
+        _chat_buckets.move_to_end(chat_id)
+    return bucket
+
+
+async def _wait_for_rate_limit(chat_id):
+    # Flood-wait from a previous 429 applies to every sender
+    delay = _cooldown_until - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    if chat_id is not None:
+        await _chat_bucket(chat_id).acquire()
+    await _global_bucket.acquire()
+
+
+async def call(method, data=None, json=None, chat_id=None):
+    """
+    Calls a Bot API method and returns (http_status, response_json).
+    Pass chat_id to apply the per-chat and global rate limits.
+    Network errors are logged and reported as status 0.
+    """
+    session = get_session()
+    url = f"{TELEGRAM_API_URL}/bot{os.getenv('TELEGRAM_TOKEN')}/{method}"
+
+    await _wait_for_rate_limit(chat_id)
+    async with _semaphore:
+        started = time.perf_counter()  # Only the HTTP round trip, not the rate-limit wait
+        try:
+            async with session.post(url, data=data, json=json) as response:
+                try:
+                    body = await response.json(content_type=None)
+                except ValueError:
+                    body = {}
+                metrics.observe("telegram", method, time.perf_counter() - started, ok=response.status == 200)
+                return response.status, body
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.observe("telegram", method, time.perf_counter() - started, ok=False)
+            logging.error(f"Telegram {method} failed: {e}")
+            return 0, {}
+
+
+async def call_with_retry(method, json, chat_id=None, max_attempts=MAX_ATTEMPTS):
+    """
+    Like call(), but retries 429 (after `retry_after`), 5xx and network errors
+    with exponential backoff. Other 4xx errors (blocked bot, unknown chat) are final.
+    Returns (http_status, response_json, attempts).
+    """
+    global _cooldown_until
+    status_code, body = 0, {}
+    for attempt in range(1, max_attempts + 1):
+        status_code, body = await call(method, json=json, chat_id=chat_id)
+        if status_code == 200:
+            return status_code, body, attempt
+
+        if status_code == 429:
+            retry_after = (body.get("parameters") or {}).get("retry_after", 1)
+            _cooldown_until = max(_cooldown_until, time.monotonic() + retry_after)
+            await asyncio.sleep(retry_after)
+        elif status_code == 0 or status_code >= 500:
+            await asyncio.sleep(min(2 ** attempt, 30) + random.random())
+        else:
+            break
+    return status_code, body, attempt
+
+
+async def send_message(chat_id, text, parse_mode="Markdown"):
+    return await call(
+        "sendMessage", json={"chat_id": chat_id, "text": text, "parse_mode": parse_mode}, chat_id=chat_id
+    )
+
+
+async def send_photo(chat_id, photo, caption=""):
+    """
+    Sends a photo: a str is treated as a Telegram file_id (no upload),
+    bytes are uploaded as a PNG.
+    """
+    if isinstance(photo, str):
+        return await call(
+            "sendPhoto", json={"chat_id": chat_id, "photo": photo, "caption": caption}, chat_id=chat_id
+        )
+
+    form = aiohttp.FormData()
+    form.add_field("chat_id", str(chat_id))
+    form.add_field("caption", caption)
+    form.add_field("photo", photo, filename="ticket.png", content_type="image/png")
+    return await call("sendPhoto", data=form, chat_id=chat_id)
+
+
+def photo_file_id(body):
+    """file_id of the largest size in a sendPhoto response (None if missing)."""
+    sizes = (body.get("result") or {}).get("photo") or []
+    return sizes[-1]["file_id"] if sizes else None
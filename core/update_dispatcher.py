@@ -0,0 +1,125 @@
+"""
+Concurrent dispatcher for bot updates.
+
+A fixed pool of worker threads handles updates in parallel, but updates of the
+same chat are handled one at a time, in arrival order (a user's purchase steps
+never race each other). Chats take turns, one update per turn, so a busy chat
+can't starve the others.
+
+The number of queued updates is bounded: submit() blocks (or raises queue.Full)
+once `max_pending` updates are waiting, which pushes back on the poller / webhook
+instead of growing memory during a ticket drop.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "8"))
+BOT_MAX_PENDING = int(os.getenv("BOT_MAX_PENDING", "1000"))
+
+# Latency percentiles are computed over the most recent updates
+LATENCY_WINDOW = 1000
+
+
+class UpdateDispatcher:
+
+    def __init__(self, handle, key, workers=BOT_WORKERS, max_pending=BOT_MAX_PENDING):
+        """
+        handle(update) processes one update; key(update) returns its ordering key (chat id).
+        """
+        self.handle = handle
+        self.key = key
+        self.max_pending = max_pending
+
+        self._ready = queue.Queue()  # Keys that have work and no worker on them
+        self._pending = {}           # key -> deque of (update, submitted_at)
+        self._pending_count = 0
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+
+        self._in_flight = 0
+        self._stats = {"processed": 0, "errors": 0, "rejected": 0}
+        self._wait_times = deque(maxlen=LATENCY_WINDOW)
+        self._handle_times = deque(maxlen=LATENCY_WINDOW)
+
+        self.workers = [
+            threading.Thread(target=self._work, name=f"bot-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, update, block=True, timeout=None):
+        """Queues an update. Raises queue.Full if the dispatcher stays full (non-blocking / timeout)."""
+        key = self.key(update)
+        with self._not_full:
+            if not self._not_full.wait_for(lambda: self._pending_count < self.max_pending,
+                                           timeout=timeout if block else 0):
+                self._stats["rejected"] += 1
+                raise queue.Full
+
+            chat_queue = self._pending.get(key)
+            if chat_queue is None:
+                # No queued or running update for this chat -> schedule it
+                chat_queue = self._pending[key] = deque()
+                self._ready.put(key)
+            chat_queue.append((update, time.monotonic()))
+            self._pending_count += 1
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                update, submitted_at = self._pending[key].popleft()
+                self._in_flight += 1
+
+            started = time.monotonic()
+            failed = False
+            try:
+                self.handle(update)
+            except Exception:
+                failed = True
+                logging.exception(f"Update handler failed (chat {key})")
+            finished = time.monotonic()
+
+            with self._not_full:
+                self._in_flight -= 1
+                self._pending_count -= 1
+                self._stats["processed"] += 1
+                self._stats["errors"] += failed
+                self._wait_times.append(started - submitted_at)
+                self._handle_times.append(finished - started)
+                # The key stays "taken" while it has work, so its next update runs after this one
+                if self._pending[key]:
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
+                self._not_full.notify()
+
+    def stats(self):
+        """Queue depth, in-flight updates and wait / handler latency (seconds) over recent updates."""
+        with self._lock:
+            return {
+                **self._stats,
+                "workers": len(self.workers),
+                "queue_depth": self._pending_count - self._in_flight,
+                "in_flight": self._in_flight,
+                "active_chats": len(self._pending),
+                "queue_wait": _summary(self._wait_times),
+                "handler_latency": _summary(self._handle_times),
+            }
+
+
+def _summary(samples):
+    if not samples:
+        return {"avg": 0, "p50": 0, "p95": 0, "max": 0}
+    ordered = sorted(samples)
+    return {
+        "avg": round(sum(ordered) / len(ordered), 4),
+        "p50": round(ordered[len(ordered) // 2], 4),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+        "max": round(ordered[-1], 4),
+    }
@@ -1,27 +1,30 @@
 import os
 import stripe
-import qrcode 
-import requests
+import base64
+import telebot
 import secrets
+import socket
+import queue
 import logging
-import aiohttp
 import asyncio
-import csv
-from io import StringIO
-from datetime import date
+from datetime import date, datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
 from dotenv import load_dotenv
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, ValidationError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 # FastAPI Imports
-from fastapi import FastAPI, HTTPException, Request, Form, Depends, status, BackgroundTasks, Response
+from fastapi import FastAPI, HTTPException, Request, Form, Depends, status, BackgroundTasks, Response, Query
+from fastapi.requests import HTTPConnection
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
 # Core Logic
-from core import db_manager
+from core import (
+    db_manager, db_async, reservations, telegram_client, broadcast, qr_service, exports, stats, metrics, sql_profiler
+)
 
 # --- Configuration & Setup ---
 
@@ -53,6 +56,15 @@ def get_current_username(request: Request):
         )
     return user
 
+# Shared with bot.py: privileged bot -> API calls send it in the X-Bot-Secret header
+BOT_API_SECRET = os.getenv("BOT_API_SECRET", "")
+
+def require_bot_secret(request: Request):
+    """Rejects calls without the bot's shared secret (and all calls if none is configured)."""
+    token = request.headers.get("x-bot-secret", "")
+    if not BOT_API_SECRET or not secrets.compare_digest(token.encode(), BOT_API_SECRET.encode()):
+        raise HTTPException(status_code=403, detail="Invalid bot secret")
+
 # 5. Middleware (CORS)
 app.add_middleware(
     CORSMiddleware,
@@ -62,23 +74,52 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 6. Third-Party Keys
+# 6. Metrics (GET /metrics, Prometheus format): per-route latency + timers around
+# every db_manager / reservations call, Stripe, Telegram and QR rendering
+app.add_middleware(metrics.MetricsMiddleware)
+# Not timed: pool plumbing, helpers that run inside an already timed call, and pure string building
+metrics.instrument_module(db_manager, "db", exclude=(
+    "get_pool", "get_connection", "get_pool_stats", "check_query_plans", "insert_ticket_rows", "fts_match_query"
+))
+metrics.instrument_module(reservations, "db")
+metrics.register_collector("partyflow_db_pool", "SQLite connection pool counters", "stat", db_manager.get_pool_stats)
+metrics.register_collector("partyflow_qr_cache", "QR code cache counters", "stat", qr_service.get_stats)
+metrics.register_collector("partyflow_db_executor", "Async DB executor load", "stat", db_async.get_stats)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # Empty -> /metrics is open (keep it off the public internet)
+
+def is_admin_request(scope):
+    """get_current_username()'s cookie check, for ASGI middleware."""
+    return bool(HTTPConnection(scope).cookies.get("session_user"))
+
+# SQL_PROFILE=1: per-request query count / DB time, slow-query log, N+1 warnings (X-SQL-Profile header for admins)
+app.add_middleware(sql_profiler.SQLProfilerMiddleware, is_admin=is_admin_request)
+
+# 7. Third-Party Keys
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 YOUR_DOMAIN = "http://127.0.0.1:8000"
 
-# 7. Static Files & Templates
+# 8. Static Files & Templates
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
+# 9. Telegram webhook mode (Optional): Telegram posts updates to /telegram/webhook and
+# the bot's handlers (bot.py) run inside the API. Unset -> run `python bot.py` (polling).
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+telegram_bot = None  # The bot module, once webhook mode is enabled (bottom of this file)
+
 
 # --- Data Models ---
 
+# Seats per checkout (the bot offers 1-5)
+MAX_TICKETS_PER_ORDER = 10
+
 class TicketRequest(BaseModel):
     event_id: int
     user_name: str
     user_id: int
     phone_number: str
-    quantity: int = 1  # Default to 1 if not provided
+    quantity: int = Field(1, gt=0, le=MAX_TICKETS_PER_ORDER)  # Default to 1 if not provided
 
 class EventRequest(BaseModel):
     name: str
@@ -90,40 +131,25 @@ class EventRequest(BaseModel):
 class LoginRequest(BaseModel):
     password: str
 
-async def send_telegram_broadcast_task(user_ids, message, event_name):
+class TicketMedia(BaseModel):
+    ticket_id: int
+    file_id: str
+
+class TicketMediaRequest(BaseModel):
+    media: list[TicketMedia]
+
+async def send_telegram_broadcast_task(broadcast_id, message, event_name):
     """
-    Asynchronous version: Sends messages in parallel (non-blocking).
+    Background task: runs a stored broadcast through the rate-limited engine.
     """
-    bot_token = os.getenv("TELEGRAM_TOKEN")
-    send_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    
-    logging.info(f"🚀 Starting FAST broadcast for '{event_name}' to {len(user_ids)} users...")
-
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for user_id in user_ids:
-            full_text = (
-                f"📢 **Update regarding {event_name}**\n\n"
-                f"{message}\n\n"
-                f"-- PartyFlow Management"
-            )
-            
-            payload = {
-                "chat_id": user_id, 
-                "text": full_text, 
-                "parse_mode": "Markdown"
-            }
-            task = session.post(send_url, json=payload)
-            tasks.append(task)
-        
-        responses = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        success_count = 0
-        for response in responses:
-            if not isinstance(response, Exception) and response.status == 200:
-                success_count += 1
-                
-    logging.info(f"✅ Fast Broadcast complete! Sent to {success_count}/{len(user_ids)} users.")
+    logging.info(f"🚀 Starting broadcast #{broadcast_id} for '{event_name}'...")
+
+    full_text = (
+        f"📢 **Update regarding {event_name}**\n\n"
+        f"{message}\n\n"
+        f"-- PartyFlow Management"
+    )
+    await broadcast.run_broadcast(broadcast_id, full_text)
 
 
 # --- Routes ---
@@ -175,17 +201,66 @@ async def logout(request: Request):
 
 # -- API Routes --
 
+@app.post("/telegram/webhook")
+async def telegram_webhook(request: Request):
+    """Receives Telegram updates (webhook mode) and hands them to the bot's handlers."""
+    if telegram_bot is None:
+        raise HTTPException(status_code=404, detail="Webhook mode is disabled")
+
+    # Telegram echoes the secret we registered in this header
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not secrets.compare_digest(token, TELEGRAM_WEBHOOK_SECRET):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+
+    update = telebot.types.Update.de_json((await request.body()).decode("utf-8"))
+    # Handlers run on the bot's dispatcher workers; Telegram gets its 200 right away
+    try:
+        telegram_bot.dispatcher.submit(update, block=False)
+    except queue.Full:
+        # Telegram redelivers the update later
+        raise HTTPException(status_code=503, detail="Bot is overloaded")
+    return {"ok": True}
+
+@app.get("/api/bot_stats", dependencies=[Depends(get_current_username)])
+def get_bot_stats():
+    """Bot dispatcher queue depth and latency (webhook mode)."""
+    if telegram_bot is None:
+        raise HTTPException(status_code=404, detail="Webhook mode is disabled")
+    return {"dispatcher": telegram_bot.dispatcher.stats()}
+
 @app.get("/api/stats")
-def get_dashboard_stats():
+async def get_dashboard_stats():
     return {
-        "stats": {
-            "total_revenue": db_manager.get_total_revenue(),
-            "tickets_sold": db_manager.get_total_tickets_sold(),
-            "top_event": db_manager.get_top_event()
-        },
-        "events": db_manager.get_events()
+        "stats": await stats.get_snapshot_async(),
+        "events": await db_async.get_events_with_sales()
     }
 
+@app.get("/api/db_stats", dependencies=[Depends(get_current_username)])
+def get_db_stats():
+    """Connection pool health (hits, misses = new connects, waits) and async DB executor load."""
+    return {"pool": db_manager.get_pool_stats(), "executor": db_async.get_stats()}
+
+@app.get("/metrics")
+def get_metrics(request: Request):
+    """Prometheus scrape endpoint (send `Authorization: Bearer <METRICS_TOKEN>` if a token is set)."""
+    if METRICS_TOKEN and not secrets.compare_digest(
+        request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/broadcasts", dependencies=[Depends(get_current_username)])
+def list_broadcasts():
+    """Recent broadcasts with delivery progress and throughput."""
+    return {"broadcasts": db_manager.get_recent_broadcasts()}
+
+@app.get("/api/broadcasts/{broadcast_id}", dependencies=[Depends(get_current_username)])
+def get_broadcast(broadcast_id: int):
+    progress = db_manager.get_broadcast_progress(broadcast_id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+    return progress
+
 @app.post("/api/events")
 def add_event_api(event: EventRequest):
     db_manager.add_event(
@@ -194,13 +269,55 @@ def add_event_api(event: EventRequest):
     return {"message": "Event added successfully"}
 
 @app.get("/events")
-def get_events_api():
-    return {"events": db_manager.get_events()}
+async def get_events_api(request: Request, response: Response):
+    """
+    Active event catalog. Sends ETag / Last-Modified (catalog version) and
+    answers 304 Not Modified when the client's copy is still current.
+    """
+    version, updated_at, events = await db_async.get_catalog()
+    headers = {
+        "ETag": f'W/"catalog-{version}"',
+        "Last-Modified": formatdate(updated_at, usegmt=True),
+        "Cache-Control": "no-cache",  # Clients may keep it, but must revalidate
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        not_modified = headers["ETag"] in [tag.strip() for tag in if_none_match.split(",")]
+    elif if_modified_since:
+        try:
+            not_modified = int(updated_at) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return {"events": events}
 
 @app.get("/api/tickets/{user_id}")
-def get_tickets_api(user_id: int):
-    tickets = db_manager.get_user_tickets(user_id)
-    return {"tickets": tickets}
+async def get_tickets_api(user_id: int, after_id: int = 0, limit: int = -1):
+    """
+    A user's tickets, oldest first. With `limit`, one page is returned plus
+    `next_after_id` (the cursor of the next page, or None on the last page).
+    """
+    if limit <= 0:
+        return {"tickets": await db_async.get_user_tickets(user_id, after_id)}
+
+    # Fetch one extra row to know whether another page exists
+    tickets = await db_async.get_user_tickets(user_id, after_id, min(limit, 100) + 1)
+    page = tickets[:min(limit, 100)]
+    next_after_id = page[-1]["id"] if len(tickets) > len(page) else None
+    return {"tickets": page, "next_after_id": next_after_id}
+
+@app.post("/api/tickets/media", dependencies=[Depends(require_bot_secret)])
+async def save_ticket_media_api(request: TicketMediaRequest):
+    """Bot reports the Telegram file_ids of ticket images it uploaded (reused by /my_tickets)."""
+    await db_async.save_ticket_file_ids("view", [(m.ticket_id, m.file_id) for m in request.media])
+    return {"saved": len(request.media)}
 
 @app.post("/api/login")
 def login_api(request: LoginRequest):
@@ -212,45 +329,55 @@ def login_api(request: LoginRequest):
 
 # --- Dashboard Routes (Admin) ---
 
+def encode_cursor(direction, event_id):
+    """Opaque page token for the dashboard links: 'a' = page after event_id, 'b' = page before it."""
+    return base64.urlsafe_b64encode(f"{direction}{event_id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """Returns (after_id, before_id) for a page token; a missing or broken token means the first page."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        direction, event_id = raw[0], int(raw[1:])
+    except (ValueError, IndexError):
+        return 0, None
+    return (0, event_id) if direction == "b" else (event_id, None)
+
 @app.get("/dashboard", response_class=HTMLResponse, dependencies=[Depends(get_current_username)])
-def show_dashboard(request: Request, page: int = 1, q: str = "", view: str = "active"):
+async def show_dashboard(request: Request, cursor: str = "", page: int = 1, q: str = "", view: str = "active"):
     """
     view='active' -> standard view
     view='archived' -> archive view
+    cursor -> page token from the Previous / Next links (keyset pagination)
     """
     
     # Set fetch status (1=active, 0=archived)
     is_active_status = 0 if view == 'archived' else 1
+    per_page = 5
     
-    raw_events, total_pages = db_manager.get_events_paginated(
-        page=page, 
-        per_page=5, 
+    after_id, before_id = decode_cursor(cursor)
+    raw_events, next_after_id, prev_before_id = await db_async.get_events_page(
+        after_id=after_id,
+        before_id=before_id,
+        per_page=per_page,
         search_query=q,
         active_status=is_active_status
     )
+    # Page numbers are only a label; the total comes from a count cached per catalog version
+    total_pages = max((await db_async.count_events(is_active_status, q) + per_page - 1) // per_page, 1)
+    if not cursor:
+        page = 1
     
-    events_processed = []
-    for event in raw_events:
-        e_dict = dict(event)
-        sold = db_manager.get_tickets_sold(e_dict['id'])
-        total = e_dict['total_tickets']
-        e_dict['sold'] = sold
-        e_dict['remaining'] = total - sold
-        e_dict['percent'] = int((sold / total) * 100) if total > 0 else 0
-        events_processed.append(e_dict)
-
-    stats = {
-        "total_revenue": db_manager.get_total_revenue(),
-        "tickets_sold": db_manager.get_total_tickets_sold(),
-        "top_event": db_manager.get_top_event()
-    }
-    
+    # Sold / remaining / percent for the whole page in a single query
+    events_processed = await db_async.get_events_with_sales([e['id'] for e in raw_events])
+
     return templates.TemplateResponse("dashboard.html", {
         "request": request, 
         "events": events_processed,  
-        "stats": stats,
+        "stats": await stats.get_snapshot_async(),  # Served from memory (see core/stats.py)
         "current_page": page,
         "total_pages": total_pages,
+        "next_cursor": encode_cursor("a", next_after_id) if next_after_id else "",
+        "prev_cursor": encode_cursor("b", prev_before_id) if prev_before_id else "",
         "search_query": q,
         "view_mode": view 
     })
@@ -276,164 +403,164 @@ def broadcast_message(
     if not event:
         raise HTTPException(status_code=404, detail="Event not found")
     
-    user_ids = db_manager.get_users_with_tickets_for_event(event_id)
-    background_tasks.add_task(send_telegram_broadcast_task, user_ids, message, event['name'])
+    # Persist the job + recipients first, so progress can be followed via /api/broadcasts
+    broadcast_id = db_manager.create_broadcast(event_id, message)
+    background_tasks.add_task(send_telegram_broadcast_task, broadcast_id, message, event['name'])
     
     return RedirectResponse(url="/dashboard", status_code=303)
 
 @app.post("/dashboard/archive/{event_id}", dependencies=[Depends(get_current_username)])
 def archive_event_route(event_id: int):
     db_manager.archive_event(event_id)
+    stats.invalidate()
     # Redirect to dashboard
     return RedirectResponse(url="/dashboard", status_code=303)
 
 @app.post("/dashboard/restore/{event_id}", dependencies=[Depends(get_current_username)])
 def restore_event_route(event_id: int):
     db_manager.restore_event(event_id)
+    stats.invalidate()
     # Redirect back to archive view
     return RedirectResponse(url="/dashboard?view=archived", status_code=303)
 
-@app.get("/dashboard/export_csv", dependencies=[Depends(get_current_username)])
-def export_events_csv():
-    # 1. Fetch data
-    events = db_manager.get_all_events_for_export()
-    
-    # 2. Create CSV in memory
-    output = StringIO()
-    writer = csv.writer(output)
-    
-    # Column headers
-    writer.writerow(['ID', 'Event Name', 'Date', 'Location', 'Price (NIS)', 'Capacity', 'Tickets Sold', 'Revenue'])
-    
-    # Write rows
-    for e in events:
-        writer.writerow([
-            e['id'], 
-            e['name'], 
-            e['date'], 
-            e['location'], 
-            e['price'], 
-            e['total_tickets'], 
-            e['sold_count'], 
-            e['revenue']
-        ])
-        
-    # 3. Prepare download
-    output.seek(0)
-    
+def export_response(fmt, columns, batches, filename):
+    """Streams an export in the requested format (csv / ndjson / parquet / arrow)."""
+    reason = exports.unavailable_reason(fmt)
+    if reason:
+        raise HTTPException(status_code=400, detail=reason)
+
+    media_type, extension, _ = exports.FORMATS[fmt]
     return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=partyflow_report.csv"}
+        exports.stream(fmt, columns, batches),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}.{extension}"}
     )
 
+@app.get("/dashboard/export_csv", dependencies=[Depends(get_current_username)])
+def export_events_csv(
+    date_from: date | None = None,
+    date_to: date | None = None,
+    fmt: str = Query("csv", alias="format")
+):
+    """Events report, streamed from the DB in batches. Optional event date range."""
+    batches = db_manager.iter_events_for_export(date_from, date_to)
+    return export_response(fmt, exports.EVENT_COLUMNS, batches, "partyflow_report")
+
 @app.get("/dashboard/export_tickets", dependencies=[Depends(get_current_username)])
-def export_tickets_csv():
-    # 1. Fetch all tickets
-    tickets = db_manager.get_all_tickets_for_export()
-    
-    # 2. Create CSV in memory
-    output = StringIO()
-    writer = csv.writer(output)
-    
-    # Headers (Matches QR data)
-    writer.writerow(['Ticket ID', 'Event Name', 'Owner Name', 'Phone', 'Purchase Time', 'Telegram ID', 'QR String'])
-    
-    # Write rows
-    for t in tickets:
-        # Generate QR string (for manual verification)
-        qr_string = f"TICKET-ID:{t['ticket_id']} | EVENT:{t['event_name']} | OWNER:{t['telegram_id']}"
-        
-        writer.writerow([
-            t['ticket_id'], 
-            t['event_name'], 
-            t['user_name'], 
-            t['phone_number'], 
-            t['purchase_time'],
-            t['telegram_id'],
-            qr_string
-        ])
-        
-    # 3. Prepare download
-    output.seek(0)
-    
-    return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=guest_list.csv"}
-    )
+def export_tickets_csv(
+    event_id: int | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    fmt: str = Query("csv", alias="format")
+):
+    """Guest list, streamed from the DB in batches. Optional event and purchase date range."""
+    def with_qr_strings(batches):
+        for batch in batches:
+            for t in batch:
+                # Generate QR string (for manual verification)
+                t['qr_string'] = f"TICKET-ID:{t['ticket_id']} | EVENT:{t['event_name']} | OWNER:{t['telegram_id']}"
+            yield batch
+
+    batches = with_qr_strings(db_manager.iter_tickets_for_export(event_id, date_from, date_to))
+    return export_response(fmt, exports.TICKET_COLUMNS, batches, "guest_list")
 
 
 # --- Stripe Payment Logic ---
 
+# Stripe checkout sessions last 30 min .. 24 h. The hold outlives the session by a
+# grace period, so a buyer paying in the last minute never finds their seat resold.
+CHECKOUT_SESSION_SECONDS = max(reservations.HOLD_TTL_SECONDS, 31 * 60)
+HOLD_GRACE_SECONDS = 5 * 60
+
 @app.post("/create_checkout_session")
-def create_checkout_session(ticket: TicketRequest):
-    event = db_manager.get_event_by_id(ticket.event_id)
-    sold_count = db_manager.get_tickets_sold(ticket.event_id)
-    
+async def create_checkout_session(ticket: TicketRequest):
+    event = await db_async.get_event_by_id(ticket.event_id)
     if not event:
         raise HTTPException(status_code=404, detail="Event not found")
-    
-    # Check if enough tickets remain for the requested quantity
-    if sold_count + ticket.quantity > event['total_tickets']:
+
+    # Reserve the seats for the duration of the checkout. This is the capacity check: it is
+    # atomic and frees expired holds first (a pre-check on held_count would count them)
+    hold = await db_async.create_hold(
+        ticket.event_id, ticket.user_id, ticket.quantity, ttl=CHECKOUT_SESSION_SECONDS + HOLD_GRACE_SECONDS
+    )
+    if not hold:
         raise HTTPException(status_code=400, detail="Not enough tickets left!")
 
     try:
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'ils',
-                    'product_data': {'name': f"Ticket: {event['name']}"},
-                    'unit_amount': int(event['price'] * 100),
+        with metrics.timer("stripe", "checkout.Session.create"):
+            checkout_session = await stripe.checkout.Session.create_async(
+                payment_method_types=['card'],
+                line_items=[{
+                    'price_data': {
+                        'currency': 'ils',
+                        'product_data': {'name': f"Ticket: {event['name']}"},
+                        'unit_amount': int(event['price'] * 100),
+                    },
+                    'quantity': ticket.quantity,  # Use selected quantity
+                }],
+                mode='payment',
+                metadata={
+                    "event_id": ticket.event_id,
+                    "user_id": ticket.user_id,
+                    "user_name": ticket.user_name,
+                    "phone_number": ticket.phone_number,
+                    "quantity": ticket.quantity,  # Store quantity in metadata
+                    "hold_id": hold['id']
                 },
-                'quantity': ticket.quantity,  # Use selected quantity
-            }],
-            mode='payment',
-            metadata={
-                "event_id": ticket.event_id,
-                "user_id": ticket.user_id,
-                "user_name": ticket.user_name,
-                "phone_number": ticket.phone_number,
-                "quantity": ticket.quantity  # Store quantity in metadata
-            },
-            success_url=YOUR_DOMAIN + "/payment_success?session_id={CHECKOUT_SESSION_ID}",
-            cancel_url=YOUR_DOMAIN + "/payment_cancel",
-        )
+                # Ends HOLD_GRACE_SECONDS before the hold does
+                expires_at=int(hold['expires_at'] - HOLD_GRACE_SECONDS),
+                success_url=YOUR_DOMAIN + "/payment_success?session_id={CHECKOUT_SESSION_ID}",
+                cancel_url=YOUR_DOMAIN + f"/payment_cancel?hold_id={hold['id']}",
+            )
         return {"checkout_url": checkout_session.url}
     except Exception as e:
+        await db_async.release_hold(hold['id'])
         logging.error(f"Stripe Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/payment_success", response_class=HTMLResponse)
-def payment_success(session_id: str, request: Request):
+async def payment_success(session_id: str, request: Request, background_tasks: BackgroundTasks):
     try:
-        session = stripe.checkout.Session.retrieve(session_id)
+        with metrics.timer("stripe", "checkout.Session.retrieve"):
+            session = await stripe.checkout.Session.retrieve_async(session_id)
         if session.payment_status == 'paid':
             data = session.metadata
             quantity = int(data.get('quantity', 1)) # Default to 1 if missing
-            
-            event = db_manager.get_event_by_id(int(data['event_id']))
-            
-            # Loop to create multiple tickets
-            for i in range(quantity):
-                ticket_id = db_manager.add_ticket(
-                    event_id=int(data['event_id']),
-                    user_id=int(data['user_id']),
-                    user_name=data['user_name'],
-                    phone_number=data['phone_number']
-                )
-                
-                qr_path = generate_qr_code(ticket_id, event['name'], data['user_name'])
-                
-                caption = (
-                    f"🎉 Ticket {i+1}/{quantity} Confirmed!\n"
-                    f"Event: {event['name']}\n"
-                    f"Ticket ID: #{ticket_id}\n\n"
-                    f"Show this QR code at the entrance."
-                )
-                # Send individual QR to user
-                send_ticket_to_telegram(data['user_id'], qr_path, caption)
+            event_id = int(data['event_id'])
+
+            # Page refresh / repeated redirect -> tickets were already issued and sent
+            if await db_async.get_order_tickets(session_id):
+                return templates.TemplateResponse("success.html", {"request": request})
+
+            event = await db_async.get_event_by_id(event_id)
+
+            user = {
+                "user_id": int(data['user_id']),
+                "user_name": data['user_name'],
+                "phone_number": data['phone_number']
+            }
+
+            # Normal path: the seats reserved at checkout become tickets
+            ticket_ids, created = None, False
+            if data.get('hold_id'):
+                ticket_ids, created = await db_async.convert_hold(data['hold_id'], user, order_id=session_id)
+
+            # Hold already expired/released -> take the seats only if still available
+            if ticket_ids is None:
+                ticket_ids, created = await db_async.add_tickets_bulk(event_id, user, quantity, order_id=session_id)
+
+            if ticket_ids is None:
+                logging.error(f"Paid order {session_id} could not be fulfilled: event {event_id} sold out")
+                return "Payment received, but this event just sold out. Our team will contact you for a refund."
+            if not created:
+                # A concurrent hit for the same order issued the tickets and is delivering them
+                return templates.TemplateResponse("success.html", {"request": request})
+            stats.invalidate()
+
+            # QR rendering + Telegram delivery happen after the page is returned
+            background_tasks.add_task(
+                deliver_tickets_task, data['user_id'], event['name'], data['user_name'], ticket_ids
+            )
             
             return templates.TemplateResponse("success.html", {"request": request})
         else:
@@ -443,7 +570,10 @@ def payment_success(session_id: str, request: Request):
         return f"Error processing payment: {e}"
 
 @app.get("/payment_cancel")
-def payment_cancel():
+async def payment_cancel(hold_id: str = ""):
+    # Put the reserved seats straight back on sale
+    if hold_id:
+        await db_async.release_hold(hold_id)
     return {"message": "Order canceled. You can close this window."}
 
 
@@ -451,56 +581,200 @@ def payment_cancel():
 
 scheduler = AsyncIOScheduler()
 
-def check_and_send_reminders():
+# Identifies this process when several API workers share the database
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Short lease, renewed while the job runs: a crashed worker's lock lapses within a minute
+REMINDER_LOCK_TTL = 60
+
+def reminder_text(event):
+    return (
+        f"Today is the day!\n\n"
+        f"Get ready! **{event['name']}** is happening today.\n"
+        f"Location: {event['location']}\n\n"
+        f"See you there!"
+    )
+
+async def keep_job_lock(name):
+    """Renews a job lock this worker holds, until cancelled when the job ends."""
+    while True:
+        await asyncio.sleep(REMINDER_LOCK_TTL / 3)
+        if not await db_async.acquire_job_lock(name, WORKER_ID, REMINDER_LOCK_TTL):
+            logging.warning(f"Lost the '{name}' job lock to another worker")
+            return
+
+async def check_and_send_reminders():
+    """
+    Daily job. Runs in only one worker (DB lease lock), and each event's reminder
+    is a persisted broadcast keyed by event + date, so a restart never double-sends.
+    """
     today = date.today().isoformat()
-    logging.info(f"Scheduler running: checking for events on {today}")
+    if not await db_async.acquire_job_lock("daily_reminders", WORKER_ID, REMINDER_LOCK_TTL):
+        logging.info("Reminders are being handled by another worker.")
+        return
 
-    events = db_manager.get_events_by_date(today)
-    if not events:
-        logging.info("No events today.")
+    renewal = asyncio.create_task(keep_job_lock("daily_reminders"))
+    try:
+        logging.info(f"Scheduler running: checking for events on {today}")
+        events = await db_async.get_events_by_date(today)
+        if not events:
+            logging.info("No events today.")
+            return
+
+        for event in events:
+            logging.info(f"Found event: {event['name']}! Sending reminders...")
+            msg = reminder_text(event)
+            broadcast_id = await db_async.create_broadcast(event["id"], msg, f"reminder:{event['id']}:{today}")
+            await broadcast.run_broadcast(broadcast_id, msg)
+    finally:
+        renewal.cancel()
+        await db_async.release_job_lock("daily_reminders", WORKER_ID)
+
+async def resume_unfinished_reminders():
+    """Startup job: finishes today's reminders that were interrupted by a restart."""
+    today = date.today().isoformat()
+    unfinished = [
+        b for b in await db_async.get_unfinished_broadcasts("reminder:")
+        if b["dedupe_key"].endswith(f":{today}")
+    ]
+    if not unfinished:
         return
-    
-    token = os.getenv("TELEGRAM_TOKEN")
-    for event in events:
-        logging.info(f"Found event: {event['name']}! Sending reminders...")
-        user_ids = db_manager.get_users_with_tickets_for_event(event["id"])
-
-        for user_id in user_ids:
-            try:
-                msg = (
-                    f"Today is the day!\n\n"
-                    f"Get ready! **{event['name']}** is happening today.\n"
-                    f"Location: {event['location']}\n\n"
-                    f"See you there!"
-                )
-                requests.post(f"https://api.telegram.org/bot{token}/sendMessage", json={
-                    "chat_id": user_id, 
-                    "text": msg, 
-                    "parse_mode": "Markdown"
-                })
-            except Exception as e:
-                logging.error(f"Failed to send reminder to {user_id}: {e}")
+    if not await db_async.acquire_job_lock("daily_reminders", WORKER_ID, REMINDER_LOCK_TTL):
+        # Another worker is sending them, or a crashed one's lease hasn't lapsed yet: look again later
+        scheduler.add_job(
+            resume_unfinished_reminders, 'date', run_date=datetime.now() + timedelta(seconds=REMINDER_LOCK_TTL)
+        )
+        return
+
+    renewal = asyncio.create_task(keep_job_lock("daily_reminders"))
+    try:
+        for b in unfinished:
+            logging.info(f"Resuming reminder broadcast #{b['id']}...")
+            await broadcast.run_broadcast(b["id"], b["message"])
+    finally:
+        renewal.cancel()
+        await db_async.release_job_lock("daily_reminders", WORKER_ID)
+
+@app.on_event("startup")
+def init_database():
+    # Apply pending schema migrations (safe to run from several workers at once)
+    db_manager.create_tables()
+    logging.info("✅ Database schema up to date")
+
+@app.on_event("startup")
+async def register_telegram_webhook():
+    if telegram_bot is None:
+        return
+    telegram_bot.backend.loop = asyncio.get_running_loop()
+    try:
+        await asyncio.to_thread(
+            telegram_bot.bot.set_webhook,
+            url=f"{TELEGRAM_WEBHOOK_URL}/telegram/webhook",
+            secret_token=TELEGRAM_WEBHOOK_SECRET
+        )
+        logging.info("✅ Telegram webhook registered")
+    except Exception as e:
+        # The API itself keeps working; Telegram keeps the previously registered webhook
+        logging.error(f"Failed to register Telegram webhook: {e}")
 
 @app.on_event("startup")
 def start_scheduler():
     scheduler.add_job(check_and_send_reminders, 'cron', hour=10, minute=0)
+    scheduler.add_job(resume_unfinished_reminders)  # Once, right away
+    scheduler.add_job(db_async.release_expired_holds, 'interval', minutes=1)
     scheduler.start()
     logging.info("✅ Scheduler started")
 
+@app.on_event("shutdown")
+async def close_http_clients():
+    await telegram_client.close_session()
+    qr_service.executor.shutdown(wait=False)
+    # db_async's executor is left to drain: interrupted broadcasts still flush their progress
+
 
 # --- Helpers ---
 
-def generate_qr_code(ticket_id: int, event_name: str, user_name: str):
-    if not os.path.exists("static"):
-        os.makedirs("static")
-    data = f"TICKET-ID:{ticket_id} | EVENT:{event_name} | OWNER:{user_name}"
-    qr = qrcode.make(data)
-    file_path = f"static/ticket_{ticket_id}.png"
-    qr.save(file_path)
-    return file_path
-
-def send_ticket_to_telegram(chat_id, file_path, caption):
-    bot_token = os.getenv("TELEGRAM_TOKEN")
-    url = f"https://api.telegram.org/bot{bot_token}/sendPhoto"
-    with open(file_path, "rb") as image_file:
-        requests.post(url, data={"chat_id": chat_id, "caption": caption}, files={"photo": image_file})
\ No newline at end of file
+def ticket_qr_payload(ticket_id: int, event_name: str, user_name: str):
+    return f"TICKET-ID:{ticket_id} | EVENT:{event_name} | OWNER:{user_name}"
+
+async def deliver_tickets_task(chat_id, event_name, user_name, ticket_ids):
+    """
+    Background fulfillment: sends every ticket's QR in order through the shared
+    Telegram session. Images Telegram already has are re-sent by file_id; the rest
+    are rendered in parallel (QR service pool) and uploaded once.
+    """
+    file_ids = await db_async.get_ticket_file_ids(ticket_ids, "delivery")
+    payloads = {ticket_id: ticket_qr_payload(ticket_id, event_name, user_name) for ticket_id in ticket_ids}
+    missing = [ticket_id for ticket_id in ticket_ids if ticket_id not in file_ids]
+    images = dict(zip(missing, await qr_service.render_many_async([payloads[t] for t in missing])))
+
+    uploaded = []
+    quantity = len(ticket_ids)
+    for i, ticket_id in enumerate(ticket_ids, start=1):
+        caption = (
+            f"🎉 Ticket {i}/{quantity} Confirmed!\n"
+            f"Event: {event_name}\n"
+            f"Ticket ID: #{ticket_id}\n\n"
+            f"Show this QR code at the entrance."
+        )
+        status_code = None
+        if ticket_id in file_ids:
+            status_code, _ = await telegram_client.send_photo(chat_id, file_ids[ticket_id], caption)
+            if status_code == 400:
+                # file_id no longer accepted -> fall back to uploading the image
+                status_code = None
+                images[ticket_id] = (await qr_service.render_many_async([payloads[ticket_id]]))[0]
+
+        if status_code is None:
+            # Send individual QR to user
+            status_code, body = await telegram_client.send_photo(chat_id, images[ticket_id], caption)
+            file_id = telegram_client.photo_file_id(body) if status_code == 200 else None
+            if file_id:
+                uploaded.append((ticket_id, file_id))
+
+        if status_code != 200:
+            logging.error(f"Failed to deliver ticket #{ticket_id} to {chat_id} (HTTP {status_code})")
+
+    if uploaded:
+        await db_async.save_ticket_file_ids("delivery", uploaded)
+
+
+# --- Telegram Webhook Mode ---
+
+class InProcessBotBackend:
+    """
+    The bot's backend in webhook mode: same methods as bot.ApiClient, but
+    calling db_manager and the route functions directly (no HTTP hop).
+    Handlers run on the dispatcher's threads; async routes are run on the API's loop.
+    """
+
+    def __init__(self):
+        self.loop = None  # Set on startup
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def get_catalog(self):
+        return 200, db_manager.get_catalog()[2]
+
+    def get_tickets(self, user_id, after_id=0, limit=-1):
+        return 200, self.run(get_tickets_api(user_id, after_id, limit))
+
+    def save_ticket_media(self, media):
+        db_manager.save_ticket_file_ids("view", [(m["ticket_id"], m["file_id"]) for m in media])
+
+    def create_checkout(self, payload):
+        try:
+            return 200, self.run(create_checkout_session(TicketRequest(**payload)))
+        except ValidationError:
+            return 422, None
+        except HTTPException as e:
+            return e.status_code, None
+
+if TELEGRAM_WEBHOOK_URL:
+    if not TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET must be set when TELEGRAM_WEBHOOK_URL is")
+    import bot as telegram_bot
+    telegram_bot.backend = InProcessBotBackend()
+    metrics.register_collector(
+        "partyflow_bot_dispatcher", "Bot update dispatcher counters", "stat", telegram_bot.dispatcher.stats
+    )
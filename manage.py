@@ -3,7 +3,44 @@ import os
 
 sys.path.append(os.getcwd())
 
-from core import db_manager
+from core import db_manager, migrations
+
+def migrate():
+    with db_manager.get_connection() as conn:
+        before = migrations.get_version(conn)
+    db_manager.create_tables()
+    print(f"Schema version: {before} -> {migrations.LATEST_VERSION}")
+
+def check_plans():
+    """Exits with status 1 if any hot query does a full table scan."""
+    problems = db_manager.check_query_plans()
+    if not problems:
+        print(f"All {len(db_manager.HOT_QUERIES)} hot queries use an index ✅")
+        return True
+    for name, detail in problems:
+        print(f"❌ {name}: {detail}")
+    return False
+
+def rebuild_counters():
+    updated = db_manager.rebuild_sales_counters()
+    print(f"Recomputed sales counters for {updated} event(s) ✅")
+
+def verify_counters():
+    mismatches = db_manager.verify_sales_counters()
+    if not mismatches:
+        print("All sales counters match the tickets table ✅")
+    for m in mismatches:
+        print(f"❌ {m['id']}: {m['name']} - stored {m['sold_count']} / {m['revenue']}, "
+              f"actual {m['actual_count']} / {m['actual_revenue']}")
+    return not mismatches
+
+# Non-interactive usage: python manage.py <command>
+COMMANDS = {
+    "migrate": migrate,
+    "check_plans": check_plans,
+    "rebuild_counters": rebuild_counters,
+    "verify_counters": verify_counters,
+}
 
 def main():
     print("Initializing database...")
@@ -13,6 +50,9 @@ def main():
     print("\n--- Party Manager ---")
     print("1. Add new event")
     print("2. List all events")
+    print("3. Rebuild sales counters")
+    print("4. Verify sales counters")
+    print("5. Check hot query plans")
     
     choice = input("Choose an option: ")
     
@@ -31,5 +71,23 @@ def main():
         for event in events:
             print(f"{event['id']}: {event['name']} - {event['date']}")
 
+    elif choice == '3':
+        rebuild_counters()
+
+    elif choice == '4':
+        verify_counters()
+
+    elif choice == '5':
+        check_plans()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        command = COMMANDS.get(sys.argv[1])
+        if not command:
+            print(f"Unknown command. Available: {', '.join(COMMANDS)}")
+            sys.exit(2)
+        if command is not migrate:
+            db_manager.create_tables()
+        # Commands that return False signal failure (useful in CI)
+        sys.exit(1 if command() is False else 0)
+    main()